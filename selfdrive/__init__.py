@@ -1,2 +1,11 @@
-from . import model, image, ocr
-__all__ = [model, image, ocr]
\ No newline at end of file
+import importlib
+
+__all__ = ["model", "image", "ocr", "navigation", "vehicle_control", "visualization_utils", "metrics",
+           "pipeline", "tracking", "cache", "runtime"]
+
+
+def __getattr__(name):
+    # Submodules are imported on first access, lane-following workers never pay for tensorflow
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the selfdrive package
+Run with: python -m selfdrive.bench <command>
+"""
@@ -0,0 +1,17 @@
+import argparse
+import sys
+from . import backends, imports, replay
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m selfdrive.bench")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    imports.add_parser(subparsers)
+    replay.add_parser(subparsers)
+    backends.add_parser(subparsers)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
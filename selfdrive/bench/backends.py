@@ -0,0 +1,186 @@
+"""
+Accuracy versus latency of an exported speed-limit model against the restored checkpoint
+"""
+import itertools
+import json
+import time
+from collections import namedtuple
+import numpy as np
+from ..image.editor import CircleProposer, search_area_tiles
+from ..image.filters import CROP_SPEEDLIMIT_SCREEN, CROP_SPEEDLIMIT_AREA
+from ..model.export import FORMATS, QUANTIZATIONS, ExportOptions
+from .replay import frame_source, stage_stats
+from .synthetic import synthetic_frames
+
+BackendComparison = namedtuple("BackendComparison", ["frames", "reference", "candidate", "matched", "missed", "extra",
+                                                     "mean_iou", "max_score_delta", "load_seconds"])
+
+
+def box_iou(a, b):
+    """
+    IoU of two (ymin, xmin, ymax, xmax) boxes
+    """
+    height = max(min(a[2], b[2]) - max(a[0], b[0]), 0)
+    width = max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+    intersection = height * width
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def match_detections(reference, candidate, iou_threshold=.5):
+    """
+    Pair detections with the same label, best reference score first, each candidate used once
+    params:
+        [1] reference, candidate: SignDetection lists of the same frame
+        [2] iou_threshold: min IoU of a pair
+    return:
+        list of (reference, candidate, iou), and the unmatched candidates
+    """
+    unmatched = list(candidate)
+    pairs = []
+    for detection in sorted(reference, key=lambda d: d.score, reverse=True):
+        scored = [(box_iou(detection.box, other.box), i) for i, other in enumerate(unmatched)
+                  if other.label == detection.label]
+        iou, best = max(scored, default=(0.0, None))
+        if best is not None and iou >= iou_threshold:
+            pairs.append((detection, unmatched.pop(best), iou))
+    return pairs, unmatched
+
+
+def compare_scanners(reference, candidate, frames, iou_threshold=.5, load_seconds=None):
+    """
+    Scan every frame with both scanners, alternating which one goes first
+    params:
+        [1] reference: SpeedLimitScanner of the restored checkpoint
+        [2] candidate: SpeedLimitScanner of the export
+        [3] frames: iterable of BGR frames
+        [4] iou_threshold: min IoU of matching detections
+        [5] load_seconds: optional (reference, candidate) load_self seconds, reported as is
+    return:
+        BackendComparison, latencies per scanned frame
+    """
+    timings = ([], [])
+    matched, missed, extra = 0, 0, 0
+    ious, score_deltas = [], []
+    count = 0
+    for count, frame in enumerate(frames, 1):
+        results = [None, None]
+        order = (0, 1) if count % 2 else (1, 0)
+        for i in order:
+            scanner = (reference, candidate)[i]
+            start = time.perf_counter()
+            results[i] = scanner.scan(frame)
+            timings[i].append(time.perf_counter() - start)
+        pairs, unmatched = match_detections(results[0], results[1], iou_threshold)
+        matched += len(pairs)
+        missed += len(results[0]) - len(pairs)
+        extra += len(unmatched)
+        for detection, other, iou in pairs:
+            ious.append(iou)
+            score_deltas.append(abs(detection.score - other.score))
+    if not count:
+        raise ValueError("No frames to compare")
+    return BackendComparison(
+        frames=count,
+        reference=stage_stats("checkpoint", timings[0]),
+        candidate=stage_stats("export", timings[1]),
+        matched=matched,
+        missed=missed,
+        extra=extra,
+        mean_iou=float(np.mean(ious)) if ious else None,
+        max_score_delta=max(score_deltas, default=None),
+        load_seconds=load_seconds
+    )
+
+
+def format_comparison(result: BackendComparison, name="export"):
+    lines = ["{:<14}{:>10}{:>10}{:>10}{:>10}{:>10}".format("backend", "mean", "p50", "p90", "p99", "max")]
+    for label, stats in (("checkpoint", result.reference), (name, result.candidate)):
+        lines.append("{:<14}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+            label, stats.mean_ms, stats.p50_ms, stats.p90_ms, stats.p99_ms, stats.max_ms))
+    lines.append(f"{result.frames} frames, speedup {result.reference.mean_ms / result.candidate.mean_ms:.2f}x "
+                 f"(latencies in ms per frame)")
+    total = result.matched + result.missed
+    recall = result.matched / total if total else 1.0
+    lines.append(f"detections: {result.matched} matched, {result.missed} missed, {result.extra} extra, "
+                 f"agreement {100 * recall:.1f}%")
+    if result.mean_iou is not None:
+        lines.append(f"matched boxes: mean IoU {result.mean_iou:.3f}, max score delta {result.max_score_delta}")
+    if result.load_seconds:
+        lines.append("load_self: checkpoint {:.2f}s, {} {:.2f}s".format(result.load_seconds[0], name,
+                                                                        result.load_seconds[1]))
+    return "\n".join(lines)
+
+
+def calibration_tiles(frames, screen=CROP_SPEEDLIMIT_SCREEN, area=CROP_SPEEDLIMIT_AREA):
+    """
+    Search area tiles of frames, the inputs an int8 export is calibrated with
+    """
+    for frame in frames:
+        if screen.crop:
+            top, bottom, left, right = screen.crop
+            frame = frame[top:bottom, left:right]
+        yield from search_area_tiles(frame, area.size, area.cords)
+
+
+def run(args):
+    from ..model import speedlimit
+    if args.source:
+        frames = list(itertools.islice(frame_source(args.source), args.frames))
+    else:
+        frames = list(synthetic_frames(args.frames, args.width, args.height, args.seed))
+    # A SavedModel is never quantized
+    quantization = args.quantization if args.format == "tflite" else "float32"
+    representative = None
+    if quantization == "int8":
+        representative = list(calibration_tiles(frames[:args.calibrate]))
+    options = ExportOptions(args.format, quantization, args.cache_dir, args.threads, representative)
+
+    start = time.perf_counter()
+    reference = speedlimit.Model()
+    reference.load_self(export=None)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    candidate = speedlimit.Model()
+    candidate.load_self(export=options)
+    candidate_seconds = time.perf_counter() - start
+
+    scanners = []
+    for model in (reference, candidate):
+        proposer = CircleProposer() if args.circles else None
+        scanners.append(speedlimit.SpeedLimitScanner(model, proposer=proposer))
+    result = compare_scanners(scanners[0], scanners[1], frames, args.iou,
+                              (reference_seconds, candidate_seconds))
+    name = args.format if args.format == "saved_model" else f"tflite-{quantization}"
+    if args.json:
+        print(json.dumps({
+            **result._asdict(),
+            "backend": name,
+            "export_path": candidate.export_path,
+            "reference": result.reference._asdict(),
+            "candidate": result.candidate._asdict()
+        }, indent=2))
+    else:
+        print(format_comparison(result, name))
+        print(f"export: {candidate.export_path}")
+    return 0
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser("backends", help="compare an exported speed-limit model with the checkpoint "
+                                                    "(needs tensorflow)")
+    parser.add_argument("source", nargs="?", help="recording or image directory, synthetic frames if omitted")
+    parser.add_argument("--frames", type=int, default=200, help="max frames compared")
+    parser.add_argument("--width", type=int, default=800, help="synthetic frame width")
+    parser.add_argument("--height", type=int, default=600, help="synthetic frame height")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic frames seed")
+    parser.add_argument("--format", choices=FORMATS, default="tflite")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="dynamic",
+                        help="TFLite quantization")
+    parser.add_argument("--threads", type=int, default=None, help="TFLite interpreter threads, every core if omitted")
+    parser.add_argument("--cache-dir", default=None, help="exports directory")
+    parser.add_argument("--calibrate", type=int, default=32, help="frames calibrating an int8 export")
+    parser.add_argument("--iou", type=float, default=.5, help="min IoU of matching detections")
+    parser.add_argument("--circles", action="store_true", help="scan only the crops of a CircleProposer")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.set_defaults(func=run)
@@ -0,0 +1,56 @@
+import json
+import subprocess
+import sys
+from collections import namedtuple
+
+ImportResult = namedtuple("ImportResult", ["module", "seconds", "heavy_modules", "budget"])
+
+# Seconds a lane-following worker may spend on `import selfdrive.navigation`
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ("tensorflow", "keras_ocr", "object_detection", "matplotlib")
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy_modules": heavy}}))
+"""
+
+
+def import_time(module, budget=IMPORT_BUDGET):
+    """
+    Time `import module` in a fresh interpreter
+    params:
+        [1] module: dotted module name
+        [2] budget: allowed seconds
+    return:
+        ImportResult
+    """
+    script = _SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return ImportResult(module=module, seconds=result["seconds"], heavy_modules=result["heavy_modules"], budget=budget)
+
+
+def within_budget(result: ImportResult):
+    return result.seconds <= result.budget and not result.heavy_modules
+
+
+def run(args):
+    failed = False
+    for module in args.modules:
+        result = import_time(module, args.budget)
+        ok = within_budget(result)
+        failed = failed or not ok
+        print(f"{'ok' if ok else 'FAIL':4} {module}: {result.seconds * 1000:.1f} ms "
+              f"(budget {result.budget * 1000:.0f} ms), heavy modules: {', '.join(result.heavy_modules) or '-'}")
+    return 1 if failed else 0
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser("imports", help="time importing selfdrive modules in a fresh interpreter")
+    parser.add_argument("modules", nargs="*", default=["selfdrive.navigation", "selfdrive.vehicle_control"])
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET, help="allowed seconds per import")
+    parser.set_defaults(func=run)
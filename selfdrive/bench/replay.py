@@ -0,0 +1,172 @@
+import glob
+import json
+import os
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+from .. import navigation
+from ..tracking import LaneTracker
+from ..image.editor import CircleProposer
+from ..image.recording import RecordingReader
+from .synthetic import synthetic_frames
+
+StageStats = namedtuple("StageStats", ["name", "count", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"])
+BenchResult = namedtuple("BenchResult", ["frames", "seconds", "fps", "stages", "peak_rss_mb"])
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png")
+
+
+def frame_source(path):
+    """
+    Frames of a recording, or of the images in a directory (sorted by name)
+    """
+    if glob.glob(os.path.join(path, "segment-*.index")):
+        yield from RecordingReader(path)
+        return
+    names = sorted(name for pattern in IMAGE_PATTERNS for name in glob.glob(os.path.join(path, pattern)))
+    if not names:
+        raise FileNotFoundError("No recording or images inside {}".format(path))
+    for name in names:
+        yield cv2.imread(name)
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stage_stats(name, seconds):
+    ms = np.array(seconds) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return StageStats(name=name, count=len(ms), mean_ms=float(ms.mean()), p50_ms=float(p50),
+                      p90_ms=float(p90), p99_ms=float(p99), max_ms=float(ms.max()))
+
+
+def run_navigation(frames, region="turn", detector=True, min_slope=None, scanner=None, track=False, scale=1.0):
+    """
+    Replay frames through detect_lanes -> filter_lines -> process_lines
+    params:
+        [1] frames: iterable of BGR frames
+        [2] region: "turn" or "steer" detection region
+        [3] detector: use a LaneDetector instead of detect_lanes
+        [4] min_slope: filter_lines min_slope
+        [5] scanner: optional model.speedlimit.SpeedLimitScanner, also run on every frame
+        [6] track: use a tracking.LaneTracker, timed as a single lane_tracker stage
+        [7] scale: LaneDetector scale
+    return:
+        BenchResult
+    """
+    if track:
+        timings = {"lane_tracker": []}
+    else:
+        timings = {"detect_lanes": [], "filter_lines": [], "process_lines": []}
+    if scanner:
+        timings["speedlimit"] = []
+    lane_detector = None
+    tracker = None
+    count = 0
+    for frame in frames:
+        height, width = frame.shape[:2]
+        vertices = navigation.REGIONS[region](width, height)
+        if track:
+            if tracker is None or (tracker.width, tracker.height) != (width, height):
+                tracker = LaneTracker(width, height, vertices, min_slope=min_slope, scale=scale)
+            t0 = time.perf_counter()
+            tracker.update(frame)
+            t3 = time.perf_counter()
+            timings["lane_tracker"].append(t3 - t0)
+            if scanner:
+                scanner.scan(frame)
+                timings["speedlimit"].append(time.perf_counter() - t3)
+            count += 1
+            continue
+        if detector and (lane_detector is None or (lane_detector.width, lane_detector.height) != (width, height)):
+            lane_detector = navigation.LaneDetector(width, height, vertices, scale=scale)
+
+        t0 = time.perf_counter()
+        if detector:
+            lines, masked = lane_detector.detect(frame)
+        else:
+            lines, masked = navigation.detect_lanes(frame, navigation.Masks.yellow, vertices)
+        t1 = time.perf_counter()
+        filtered = navigation.filter_line_array(lines, min_slope)
+        t2 = time.perf_counter()
+        if filtered is not None:
+            navigation.process_lines(frame, filtered)
+        t3 = time.perf_counter()
+        timings["detect_lanes"].append(t1 - t0)
+        timings["filter_lines"].append(t2 - t1)
+        timings["process_lines"].append(t3 - t2)
+        if scanner:
+            scanner.scan(frame)
+            timings["speedlimit"].append(time.perf_counter() - t3)
+        count += 1
+    if not count:
+        raise ValueError("No frames to replay")
+    # Pipeline time only, reading or generating frames isn't counted
+    seconds = sum(sum(values) for values in timings.values())
+    return BenchResult(
+        frames=count,
+        seconds=seconds,
+        fps=count / seconds,
+        stages=[stage_stats(name, values) for name, values in timings.items()],
+        peak_rss_mb=peak_rss_mb()
+    )
+
+
+def format_result(result: BenchResult):
+    lines = ["{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format("stage", "count", "mean", "p50", "p90", "p99", "max")]
+    for stage in result.stages:
+        lines.append("{:<14}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(*stage))
+    lines.append(f"{result.frames} frames in {result.seconds:.2f}s, {result.fps:.1f} FPS (latencies in ms)")
+    if result.peak_rss_mb is not None:
+        lines.append(f"peak RSS {result.peak_rss_mb:.1f} MB")
+    return "\n".join(lines)
+
+
+def run(args):
+    if args.source:
+        frames = frame_source(args.source)
+    else:
+        frames = synthetic_frames(args.frames, args.width, args.height, args.seed)
+    scanner = None
+    if args.speedlimit:
+        from ..model import speedlimit
+        model = speedlimit.Model()
+        model.load_self()
+        proposer = CircleProposer() if args.circles else None
+        scanner = speedlimit.SpeedLimitScanner(model, proposer=proposer)
+    result = run_navigation(frames, args.region, not args.no_detector, args.min_slope, scanner, args.track,
+                            args.scale)
+    if args.json:
+        print(json.dumps({
+            **result._asdict(),
+            "stages": [stage._asdict() for stage in result.stages]
+        }, indent=2))
+    else:
+        print(format_result(result))
+    return 0
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser("navigation", help="replay frames through the navigation pipeline")
+    parser.add_argument("source", nargs="?", help="recording or image directory, synthetic frames if omitted")
+    parser.add_argument("--frames", type=int, default=300, help="number of synthetic frames")
+    parser.add_argument("--width", type=int, default=800, help="synthetic frame width")
+    parser.add_argument("--height", type=int, default=600, help="synthetic frame height")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic frames seed")
+    parser.add_argument("--region", choices=sorted(navigation.REGIONS), default="turn")
+    parser.add_argument("--min-slope", type=float, default=None)
+    parser.add_argument("--no-detector", action="store_true", help="use detect_lanes instead of LaneDetector")
+    parser.add_argument("--scale", type=float, default=1.0, help="LaneDetector scale, e.g. .5 to detect at half size")
+    parser.add_argument("--track", action="store_true", help="use the temporal LaneTracker")
+    parser.add_argument("--speedlimit", action="store_true", help="also run the speed-limit scanner (needs tensorflow)")
+    parser.add_argument("--circles", action="store_true", help="scan only the crops of a CircleProposer")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.set_defaults(func=run)
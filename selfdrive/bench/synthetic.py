@@ -0,0 +1,27 @@
+import cv2
+import numpy as np
+
+ROAD_COLOR = (70, 70, 70)
+LANE_COLOR = (0, 220, 230)  # BGR, inside navigation.Masks.yellow
+
+
+def synthetic_frames(count, width=800, height=600, seed=0):
+    """
+    Road-like BGR frames with a yellow lane line drifting between frames, for benchmarks without data
+    params:
+        [1] count: number of frames
+        [2] width, height: frame size
+        [3] seed: noise and drift seed
+    """
+    rng = np.random.default_rng(seed)
+    drift = 0.0
+    thickness = max(width // 100, 2)
+    for _ in range(count):
+        drift = float(np.clip(drift + rng.normal(0, width / 200), -width / 8, width / 8))
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = ROAD_COLOR
+        frame += rng.integers(0, 12, size=frame.shape, dtype=np.uint8)
+        bottom = (int(width * 0.05), height - 1)
+        top = (int(width * 0.55 + drift), int(height * 0.45))
+        cv2.line(frame, bottom, top, LANE_COLOR, thickness, cv2.LINE_AA)
+        yield frame
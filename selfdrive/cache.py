@@ -0,0 +1,172 @@
+"""
+Bounded result cache keyed by a perceptual hash of the input image
+
+Speed-limit signs stay in view for many frames, so detection and OCR run again and
+again on nearly identical crops. A PerceptualCache returns the result of an earlier
+crop whose dHash is within max_distance bits of the new one, until its ttl runs out.
+"""
+import collections
+import threading
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+
+CacheStats = namedtuple("CacheStats", ["hits", "misses", "expired", "evictions", "bypassed", "size", "hit_rate"])
+
+_MISS = object()
+
+
+def dhash(image, size=16, threshold=2):
+    """
+    Difference hash, a size * size bits int
+    Compares neighbouring cells of a (size + 1) x size gray thumbnail, so it survives
+    small shifts, scaling and exposure changes. Differences up to threshold gray levels
+    count as equal, otherwise sensor noise flips the bits of flat regions (road, sky).
+    """
+    # Linear to 4x the thumbnail then an integer factor INTER_AREA,
+    # a single non-integer INTER_AREA is about 3x slower
+    thumbnail = cv2.resize(image, (4 * (size + 1), 4 * size), interpolation=cv2.INTER_LINEAR)
+    thumbnail = cv2.resize(thumbnail, (size + 1, size), interpolation=cv2.INTER_AREA)
+    if thumbnail.ndim == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    thumbnail = thumbnail.astype(np.int16)
+    bits = (thumbnail[:, 1:] - thumbnail[:, :-1]) > threshold
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a, b):
+    return _popcount(a ^ b)
+
+
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+    # Python < 3.10
+    def _popcount(value):
+        return bin(value).count("1")
+
+
+class PerceptualCache:
+    """
+    LRU cache with a time to live, looked up by Hamming distance between dHashes
+    Thread safe. Results are shared, callers must not modify them.
+    The hash doesn't see fine detail: a sign whose digits change at the same spot
+    (30 -> 80) can hit the old result until it expires, keep ttl short. A small sign
+    appearing in an empty scene moves the hash by a few bits only, so don't store
+    "nothing found" results (see get_or_compute's store).
+    """
+
+    def __init__(self, max_entries=256, ttl=1.0, max_distance=8, hash_size=16, enabled=True):
+        """
+        params:
+            [1] max_entries: least recently used entries are evicted past it
+            [2] ttl: seconds an entry is served after it was stored
+            [3] max_distance: max differing hash bits of a hit
+            [4] hash_size: dHash side, hash_size ** 2 bits
+            [5] enabled: False bypasses the cache, every lookup misses and nothing is stored
+        """
+        if max_entries < 1:
+            raise ValueError("Value must be at least 1")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.enabled = enabled
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+        self._bypassed = 0
+
+    def fingerprint(self, image):
+        return dhash(image, self.hash_size)
+
+    def _find(self, fingerprint, tag):
+        """
+        Key of the closest entry within max_distance, exact matches first
+        """
+        if (tag, fingerprint) in self._entries:
+            return tag, fingerprint
+        best, best_distance = None, self.max_distance + 1
+        for key in self._entries:
+            if key[0] != tag:
+                continue
+            distance = hamming(key[1], fingerprint)
+            if distance < best_distance:
+                best, best_distance = key, distance
+        return best
+
+    def get(self, fingerprint, tag=None, default=None):
+        """
+        params:
+            [1] fingerprint: fingerprint() of the image
+            [2] tag: results of different tags (e.g. models or modes) never match
+            [3] default: returned on a miss
+        """
+        if not self.enabled:
+            with self._lock:
+                self._bypassed += 1
+            return default
+        with self._lock:
+            key = self._find(fingerprint, tag)
+            if key is not None:
+                value, stored = self._entries[key]
+                if time.monotonic() - stored <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._entries[key]
+                self._expired += 1
+            self._misses += 1
+            return default
+
+    def put(self, fingerprint, value, tag=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[(tag, fingerprint)] = (value, time.monotonic())
+            self._entries.move_to_end((tag, fingerprint))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def get_or_compute(self, image, compute, tag=None, store=None):
+        """
+        Cached result of image, or compute() stored as its result
+        params:
+            [1] image: the input compute() works on
+            [2] compute: callable computing the result
+            [3] tag: as in get()
+            [4] store: optional result -> bool, results it rejects are returned but not stored
+        """
+        if not self.enabled:
+            with self._lock:
+                self._bypassed += 1
+            return compute()
+        fingerprint = self.fingerprint(image)
+        value = self.get(fingerprint, tag, _MISS)
+        if value is _MISS:
+            value = compute()
+            if store is None or store(value):
+                self.put(fingerprint, value, tag)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                expired=self._expired,
+                evictions=self._evictions,
+                bypassed=self._bypassed,
+                size=len(self._entries),
+                hit_rate=self._hits / lookups if lookups else 0.0
+            )
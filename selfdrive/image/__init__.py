@@ -1,2 +1,2 @@
-from . import editor, filters, buffer
-__all__ = [editor, filters, buffer]
\ No newline at end of file
+from . import editor, filters, buffer, recording
+__all__ = [editor, filters, buffer, recording]
\ No newline at end of file
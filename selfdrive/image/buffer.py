@@ -1,25 +1,208 @@
-import queue
-import uuid
+import collections
+import functools
 import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import cv2
+import numpy as np
 from .editor import ImageEditor
+from .recording import RecordingWriter, SEGMENT_BYTES
+
+BufferMetrics = namedtuple("BufferMetrics", ["queued", "dropped", "written", "pending"])
+BufferedFrame = namedtuple("BufferedFrame", ["image", "timestamp", "values", "scores"])
+
+
+class DropPolicy:
+    """
+    What write() does when the buffer is full
+    """
+    oldest = "oldest"  # drop the oldest queued frame
+    newest = "newest"  # drop the frame being written
+    block = "block"  # wait for save_to_disk to make room
+
+
+class JpegBackend:
+    """
+    One JPEG file per frame, {label}-{index}.jpg inside the session directory
+    """
+
+    def jobs(self, sub_dir, label, frames):
+        """
+        return:
+            (frame count, callable) jobs for the writer pool
+        """
+        return [
+            (1, functools.partial(write_jpeg, os.path.join(sub_dir, "{}-{:06d}.jpg".format(label, i)), frame.image))
+            for i, frame in enumerate(frames)
+        ]
+
+
+class RecordingBackend:
+    """
+    One segmented recording per session, in a {label} directory inside the session directory
+    Frames keep their timestamp and telemetry, see recording.RecordingReader
+    """
+
+    def __init__(self, segment_bytes=SEGMENT_BYTES, compress=False):
+        self.segment_bytes = segment_bytes
+        self.compress = compress
+
+    def _write(self, path, frames):
+        with RecordingWriter(path, self.segment_bytes, self.compress) as writer:
+            for frame in frames:
+                writer.append(bgr_array(frame.image), frame.timestamp, frame.values, frame.scores)
+
+    def jobs(self, sub_dir, label, frames):
+        # Appends are sequential, the whole session is one job
+        return [(len(frames), functools.partial(self._write, os.path.join(sub_dir, label), frames))]
 
 
 class ImageBuffer:
-    def __init__(self, path):
-        self._buffer_queue = queue.Queue()
+    """
+    Bounded frame buffer, flushed to numbered session directories by a pool of writer threads
+    """
+
+    def __init__(self, path, max_frames=1024, drop_policy=DropPolicy.oldest, workers=2, backend=None):
+        """
+        params:
+            [1] path: root directory of the sessions
+            [2] max_frames: frames kept in memory until save_to_disk
+            [3] drop_policy: DropPolicy, when more than max_frames are written
+            [4] workers: threads encoding and writing frames
+            [5] backend: JpegBackend (default) or RecordingBackend
+        """
+        if max_frames < 1:
+            raise ValueError("Value must be at least 1")
+        if drop_policy not in (DropPolicy.oldest, DropPolicy.newest, DropPolicy.block):
+            raise ValueError(f"Unknown drop policy {drop_policy}")
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self.max_frames = max_frames
+        self.drop_policy = drop_policy
         self.path = path
+        self.backend = backend or JpegBackend()
         self.editor = ImageEditor()
         if not os.path.isdir(self.path):
             os.makedirs(self.path)
+        self._next_sub_dir = max((int(name) for name in os.listdir(self.path) if name.isdigit()), default=0) + 1
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ImageBuffer")
+        self._dropped = 0
+        self._written = 0
+        self._pending = 0
 
-    def write(self, image):
-        self._buffer_queue.put(image)
+    def write(self, image, timestamp=None, values=None, scores=None):
+        """
+        Queue a frame, a PIL image or a BGR numpy array
+        params:
+            [1] image: the frame
+            [2] timestamp: seconds, time.time() if None
+            [3] values, scores: PhysicsControl.get_values() and NavScores, kept by RecordingBackend
+        return:
+            False if the frame was dropped
+        """
+        frame = BufferedFrame(image=image, timestamp=time.time() if timestamp is None else timestamp,
+                              values=values, scores=scores)
+        with self._condition:
+            if len(self._buffer) >= self.max_frames:
+                if self.drop_policy == DropPolicy.newest:
+                    self._dropped += 1
+                    return False
+                if self.drop_policy == DropPolicy.oldest:
+                    self._buffer.popleft()
+                    self._dropped += 1
+                else:
+                    self._condition.wait_for(lambda: len(self._buffer) < self.max_frames)
+            self._buffer.append(frame)
+            return True
+
+    def _allocate_sub_dir(self):
+        while True:
+            sub_dir = os.path.join(self.path, str(self._next_sub_dir))
+            self._next_sub_dir += 1
+            try:
+                os.makedirs(sub_dir)
+                return sub_dir
+            except FileExistsError:
+                # Created by someone else since we scanned
+                continue
 
     def save_to_disk(self, label):
-        sub_dir = 1
-        while os.path.isdir(os.path.join(self.path, str(sub_dir))):
-            sub_dir += 1
-        os.makedirs(os.path.join(self.path, str(sub_dir)))
-        while self._buffer_queue.qsize() > 0:
-            self._buffer_queue.get().save(
-                os.path.join(self.path, str(sub_dir), "{}-{}.jpg".format(label, uuid.uuid1())))
\ No newline at end of file
+        """
+        Move every queued frame to a new session directory, in the background
+        params:
+            [1] label: file name prefix
+        return:
+            Future, resolved with the session directory once every frame is written
+        """
+        with self._condition:
+            frames, self._buffer = self._buffer, collections.deque()
+            sub_dir = self._allocate_sub_dir()
+            self._pending += len(frames)
+            self._condition.notify_all()
+
+        done = Future()
+        if not frames:
+            done.set_result(sub_dir)
+            return done
+        jobs = self.backend.jobs(sub_dir, label, frames)
+        remaining = [len(jobs)]
+        errors = []
+
+        def job_done(count, future):
+            with self._condition:
+                self._pending -= count
+                if future.exception():
+                    errors.append(future.exception())
+                else:
+                    self._written += count
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                if errors:
+                    done.set_exception(errors[0])
+                else:
+                    done.set_result(sub_dir)
+
+        for count, job in jobs:
+            self._executor.submit(job).add_done_callback(functools.partial(job_done, count))
+        return done
+
+    def metrics(self):
+        with self._condition:
+            return BufferMetrics(queued=len(self._buffer), dropped=self._dropped,
+                                 written=self._written, pending=self._pending)
+
+    def close(self):
+        """
+        Wait for the writers, queued frames that were not saved are discarded
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def bgr_array(image):
+    """
+    Frame as a BGR (or gray) array, the layout recordings are read back with
+    PIL images are RGB, write_jpeg saves them as such but cv2 readers expect BGR
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    array = np.asarray(image)
+    return array if array.ndim == 2 else cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+
+
+def write_jpeg(path, image):
+    if isinstance(image, np.ndarray):
+        if not cv2.imwrite(path, image):
+            raise OSError(f"Could not write {path}")
+    else:
+        image.save(path)
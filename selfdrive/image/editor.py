@@ -3,15 +3,25 @@ import cv2
 from collections import namedtuple
 
 CIRCLE_CROP = namedtuple("circle", ["minDist", "dp", "param1", "param2", "minRadius", "maxRadius"])
+SignCandidate = namedtuple("SignCandidate", ["crop", "box", "circle", "rim"])
+
+# HoughCircles parameters, in pixels of the image the circles are searched in
+DEFAULT_CIRCLE_CROP = CIRCLE_CROP(minDist=20, dp=1.2, param1=100, param2=30, minRadius=8, maxRadius=80)
+# HSV ranges of a red sign rim, red wraps around hue 0
+RED_RIM = (
+    ((0, 70, 50), (10, 255, 255)),
+    ((170, 70, 50), (180, 255, 255))
+)
+# Ring radii checked for red, relative to a found circle's radius
+RIM_RADII = (.8, .95, 1.1, 1.25)
 
 
 class ImageEditor:
-    def __init__(self, path=None, img=None):
+    def __init__(self, path=None, img=None, circle_crop=DEFAULT_CIRCLE_CROP):
         self.img = img
         if path:
             self.img = cv2.imread(path)
-        self.circle_crop = CIRCLE_CROP(minDist=0, dp=0, param1=0,
-                                       param2=0, minRadius=0, maxRadius=1)
+        self.circle_crop = circle_crop
 
     @property
     def img(self):
@@ -34,8 +44,8 @@ class ImageEditor:
                                    maxRadius=self.circle_crop.maxRadius)
         ret = []
         if circles is not None:
+            circles = np.uint16(np.around(circles))
             for i in range(len(circles[0])):
-                circles = np.uint16(np.around(circles))
                 x, y, r = (int(x) for x in circles[0][i])
                 left, top, right, bottom = adjust_image_box(
                     box=(x - 100, y - 100, x + 100, y + 100),
@@ -64,6 +74,121 @@ class ImageEditor:
         return self.img
 
 
+def search_area_tiles(img, size, cords):
+    """
+    Stack every search area of img into one (len(cords), height, width, ...) array
+    The areas are strided views of img, the returned batch is the only copy
+    params:
+        [1] img: image array
+        [2] size: (height, width) of an area
+        [3] cords: (top, left) of every area, as in filters.CROP_SPEEDLIMIT_AREA
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(img, size, axis=(0, 1))
+    # (rows, cols, channels, height, width) -> (rows, cols, height, width, channels)
+    windows = np.moveaxis(windows, (-2, -1), (2, 3))
+    tops, lefts = np.array(cords).T
+    return windows[tops, lefts]
+
+
+class CircleProposer:
+    """
+    Proposes speed-limit sign crops around red-rimmed circles, instead of scanning fixed tiles
+    Circles are searched in a downscaled gray frame, each circle's rim is checked
+    for red and the strongest candidates are cropped from the full frame.
+    """
+
+    def __init__(self, size=(200, 200), scale=.5, circle_crop=DEFAULT_CIRCLE_CROP, min_rim=.5, max_candidates=8):
+        """
+        params:
+            [1] size: (height, width) of the crops, the detection model's input
+            [2] scale: resolution circles are searched at, relative to the frame
+            [3] circle_crop: HoughCircles parameters, in downscaled pixels
+            [4] min_rim: fraction of a circle's rim that must be red
+            [5] max_candidates: strongest circles kept per frame
+        """
+        if not 0 < scale <= 1:
+            raise ValueError("Scale must be in (0, 1]")
+        self.size = size
+        self.scale = scale
+        self.circle_crop = circle_crop
+        self.min_rim = min_rim
+        self.max_candidates = max_candidates
+        self._interpolation = cv2.INTER_AREA if (1 / scale).is_integer() else cv2.INTER_LINEAR
+
+    def _rim_fraction(self, hsv, x, y, r):
+        """
+        Red fraction of the reddest thin ring from .8r to 1.25r around (x, y), in the downscaled frame
+        HoughCircles locks onto either edge of the rim, so several radii are tried
+        """
+        outer = int(np.ceil(1.35 * r)) + 1
+        top, left = max(y - outer, 0), max(x - outer, 0)
+        patch = hsv[top:y + outer + 1, left:x + outer + 1]
+        red = cv2.inRange(patch, *map(np.array, RED_RIM[0]))
+        cv2.bitwise_or(red, cv2.inRange(patch, *map(np.array, RED_RIM[1])), dst=red)
+        ring = np.empty(patch.shape[:2], dtype=np.uint8)
+        best = 0.0
+        for factor in RIM_RADII:
+            ring.fill(0)
+            cv2.circle(ring, (x - left, y - top), int(round(factor * r)), 255, max(int(round(.15 * r)), 1))
+            ring_pixels = cv2.countNonZero(ring)
+            if ring_pixels:
+                best = max(best, cv2.countNonZero(cv2.bitwise_and(red, ring)) / ring_pixels)
+        return best
+
+    def _crop_box(self, frame_shape, x, y, r):
+        """
+        (top, left, bottom, right) of a crop centered on the circle, at least size and inside the frame
+        """
+        height = min(max(self.size[0], int(2.4 * r)), frame_shape[0])
+        width = min(max(self.size[1], int(2.4 * r)), frame_shape[1])
+        top = min(max(y - height // 2, 0), frame_shape[0] - height)
+        left = min(max(x - width // 2, 0), frame_shape[1] - width)
+        return top, left, top + height, left + width
+
+    def propose(self, frame):
+        """
+        params:
+            [1] frame: BGR frame
+        return:
+            list of SignCandidate, strongest circle first. crop is size, resized when the
+            sign is larger; box is its (top, left, bottom, right) in the frame, and circle
+            the (x, y, r) in frame pixels
+        """
+        height, width = frame.shape[:2]
+        small = frame
+        if self.scale != 1:
+            small_size = (max(int(round(width * self.scale)), 1), max(int(round(height * self.scale)), 1))
+            small = cv2.resize(frame, small_size, interpolation=self._interpolation)
+        gray = cv2.medianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 5)
+        circles = cv2.HoughCircles(gray,
+                                   cv2.HOUGH_GRADIENT,
+                                   minDist=self.circle_crop.minDist,
+                                   dp=self.circle_crop.dp,
+                                   param1=self.circle_crop.param1,
+                                   param2=self.circle_crop.param2,
+                                   minRadius=self.circle_crop.minRadius,
+                                   maxRadius=self.circle_crop.maxRadius)
+        if circles is None:
+            return []
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        ret = []
+        for x, y, r in np.around(circles[0]).astype(int).tolist():
+            if r <= 0:
+                continue
+            rim = self._rim_fraction(hsv, x, y, r)
+            if rim < self.min_rim:
+                continue
+            x, y, r = (int(round(v / self.scale)) for v in (x, y, r))
+            top, left, bottom, right = self._crop_box(frame.shape, x, y, r)
+            crop = frame[top:bottom, left:right]
+            if crop.shape[:2] != tuple(self.size):
+                crop = cv2.resize(crop, self.size[::-1], interpolation=cv2.INTER_AREA)
+            ret.append(SignCandidate(crop=crop, box=(top, left, bottom, right), circle=(x, y, r), rim=rim))
+            if len(ret) == self.max_candidates:
+                break
+        return ret
+
+
 def adjust_image_box(box, shape):
     left, top, right, bottom = box
     while left < 0:
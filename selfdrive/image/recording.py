@@ -0,0 +1,207 @@
+"""
+Append-only segmented recording of frames and telemetry
+
+A recording is a directory of segments, each made of three files:
+    segment-00000.frames  raw (or zlib compressed) frame bytes, back to back
+    segment-00000.index   one INDEX_DTYPE record per frame
+    segment-00000.jsonl   one line of telemetry per frame
+Raw segments are memory-mapped when read, frames come back as zero-copy views.
+"""
+import glob
+import json
+import os
+import time
+import zlib
+import cv2
+import numpy as np
+from ..navigation import NavScores
+from ..vehicle_control import Values
+
+SEGMENT_BYTES = 1 << 30
+INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("size", "<u8"),
+    ("timestamp", "<f8"),
+    ("shape", "<u4", (3,)),
+    ("ndim", "u1"),
+    ("dtype", "S8"),
+    ("compressed", "u1")
+])
+
+
+def _segment_path(path, segment, extension):
+    return os.path.join(path, "segment-{:05d}.{}".format(segment, extension))
+
+
+def _segment_count(path):
+    return len(glob.glob(os.path.join(path, "segment-*.index")))
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class RecordingWriter:
+    """
+    Appends frames to a recording, a new segment is started every segment_bytes
+    """
+
+    def __init__(self, path, segment_bytes=SEGMENT_BYTES, compress=False):
+        """
+        params:
+            [1] path: recording directory, appending to an existing recording starts a new segment
+            [2] segment_bytes: frame bytes per segment
+            [3] compress: zlib compress frames, reads then copy instead of returning views
+        """
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.compress = compress
+        os.makedirs(self.path, exist_ok=True)
+        self._segment = _segment_count(self.path)
+        self.frame_count = sum(
+            os.path.getsize(_segment_path(self.path, i, "index")) // INDEX_DTYPE.itemsize
+            for i in range(self._segment)
+        )
+        self._files = None
+        self._segment_size = 0
+
+    def _open_segment(self):
+        self._close_segment()
+        self._files = (
+            open(_segment_path(self.path, self._segment, "frames"), "ab"),
+            open(_segment_path(self.path, self._segment, "index"), "ab"),
+            open(_segment_path(self.path, self._segment, "jsonl"), "a")
+        )
+        self._segment += 1
+        self._segment_size = 0
+
+    def _close_segment(self):
+        if self._files:
+            for file in self._files:
+                file.close()
+            self._files = None
+
+    def append(self, frame, timestamp=None, values: Values = None, scores: NavScores = None):
+        """
+        params:
+            [1] frame: image array, up to 3 dimensions
+            [2] timestamp: seconds, time.time() if None
+            [3] values: PhysicsControl.get_values() of this frame
+            [4] scores: NavScores of this frame
+        return:
+            frame number
+        """
+        frame = np.ascontiguousarray(frame)
+        if frame.ndim > 3:
+            raise ValueError(f"Frames have up to 3 dimensions, got {frame.ndim}")
+        data = frame.tobytes()
+        if self.compress:
+            data = zlib.compress(data, 1)
+        if self._files is None or (self._segment_size and self._segment_size + len(data) > self.segment_bytes):
+            self._open_segment()
+        frames_file, index_file, telemetry_file = self._files
+
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record["offset"] = self._segment_size
+        record["size"] = len(data)
+        record["timestamp"] = time.time() if timestamp is None else timestamp
+        record["shape"][0, :frame.ndim] = frame.shape
+        record["ndim"] = frame.ndim
+        record["dtype"] = frame.dtype.str
+        record["compressed"] = self.compress
+        frames_file.write(data)
+        index_file.write(record.tobytes())
+        telemetry_file.write(json.dumps({
+            "values": values._asdict() if values is not None else None,
+            "scores": scores._asdict() if scores is not None else None
+        }, default=_json_default) + "\n")
+        self._segment_size += len(data)
+        self.frame_count += 1
+        return self.frame_count - 1
+
+    def flush(self):
+        if self._files:
+            for file in self._files:
+                file.flush()
+
+    def close(self):
+        self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordingReader:
+    """
+    Random access to the frames and telemetry of a recording
+    """
+
+    def __init__(self, path):
+        self.path = path
+        indices, segments = [], []
+        for segment in range(_segment_count(self.path)):
+            index = np.fromfile(_segment_path(self.path, segment, "index"), dtype=INDEX_DTYPE)
+            indices.append(index)
+            segments.append(np.full(len(index), segment, dtype=np.int64))
+        self.index = np.concatenate(indices) if indices else np.zeros(0, dtype=INDEX_DTYPE)
+        self._segments = np.concatenate(segments) if segments else np.zeros(0, dtype=np.int64)
+        # Position of a frame inside its segment, for the telemetry lines
+        self._positions = np.concatenate([np.arange(len(index)) for index in indices]) if indices else self._segments
+        self._maps = {}
+        self._telemetry = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def timestamps(self):
+        return self.index["timestamp"]
+
+    def _frames_map(self, segment):
+        if segment not in self._maps:
+            self._maps[segment] = np.memmap(_segment_path(self.path, segment, "frames"), dtype=np.uint8, mode="r")
+        return self._maps[segment]
+
+    def __getitem__(self, frame_number):
+        """
+        return:
+            the frame, a read-only view of the segment unless it is compressed
+        """
+        record = self.index[frame_number]
+        data = self._frames_map(self._segments[frame_number])[record["offset"]:record["offset"] + record["size"]]
+        shape = tuple(int(v) for v in record["shape"][:record["ndim"]])
+        dtype = np.dtype(record["dtype"].decode())
+        if record["compressed"]:
+            return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+        return data.view(dtype).reshape(shape)
+
+    def __iter__(self):
+        for frame_number in range(len(self)):
+            yield self[frame_number]
+
+    def telemetry(self, frame_number):
+        """
+        return:
+            (Values, NavScores) recorded with the frame, None where missing
+        """
+        segment = int(self._segments[frame_number])
+        if segment not in self._telemetry:
+            with open(_segment_path(self.path, segment, "jsonl")) as f:
+                self._telemetry[segment] = f.readlines()
+        line = json.loads(self._telemetry[segment][self._positions[frame_number]])
+        values = Values(**line["values"]) if line["values"] is not None else None
+        scores = NavScores(**line["scores"]) if line["scores"] is not None else None
+        return values, scores
+
+    def export_jpeg(self, path, label):
+        """
+        Write every frame as {label}-{frame number}.jpg into path, the ImageBuffer JPEG layout
+        """
+        os.makedirs(path, exist_ok=True)
+        for frame_number, frame in enumerate(self):
+            cv2.imwrite(os.path.join(path, "{}-{:06d}.jpg".format(label, frame_number)), frame)
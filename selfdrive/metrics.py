@@ -0,0 +1,212 @@
+"""
+Opt-in per-stage timing for the navigation, model and ocr pipelines
+
+    metrics.enable()
+    ...
+    metrics.snapshot()  /  metrics.to_prometheus()  /  metrics.to_json()
+
+    with metrics.trace("frame.json"):  # Chrome trace-event file of one frame
+        ...
+
+While disabled, stage() hands back a shared no-op context manager.
+"""
+import bisect
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+# Histogram bucket upper bounds in seconds, 1us to ~16s in powers of 2
+BUCKETS = tuple(2 ** i / 1e6 for i in range(25))
+
+StageSnapshot = namedtuple("StageSnapshot", ["count", "total", "min", "max", "p50", "p90", "p99", "buckets"])
+
+_enabled = False
+_trace_events = None
+_lock = threading.Lock()
+_histograms = {}
+
+
+class Histogram:
+    """
+    Fixed-size duration histogram
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile, capped by the max seen
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return StageSnapshot(
+            count=self.count,
+            total=self.total,
+            min=self.min if self.count else 0.0,
+            max=self.max,
+            p50=self.quantile(.5),
+            p90=self.quantile(.9),
+            p99=self.quantile(.99),
+            buckets=tuple(self.counts)
+        )
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def record(name, seconds, start=None):
+    """
+    Add a duration to the name stage, and to the trace being recorded
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.record(seconds)
+        if _trace_events is not None and start is not None:
+            _trace_events.append({
+                "name": name,
+                "cat": name.split(".")[0],
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": seconds * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident()
+            })
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start, self.start)
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    """
+    Context manager timing the name stage, a no-op while disabled
+    """
+    if _enabled:
+        return _Stage(name)
+    return _NULL_STAGE
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as the name stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+def snapshot():
+    """
+    return:
+        {stage name: StageSnapshot}
+    """
+    with _lock:
+        return {name: histogram.snapshot() for name, histogram in _histograms.items()}
+
+
+def to_json():
+    return json.dumps({
+        name: {**stage_snapshot._asdict(), "bucket_bounds": BUCKETS + ("+Inf",)}
+        for name, stage_snapshot in snapshot().items()
+    }, indent=2)
+
+
+def to_prometheus(metric="selfdrive_stage_seconds"):
+    """
+    Prometheus text exposition of every stage histogram
+    """
+    lines = [f"# HELP {metric} Duration of selfdrive pipeline stages", f"# TYPE {metric} histogram"]
+    for name, stage_snapshot in sorted(snapshot().items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), stage_snapshot.buckets):
+            cumulative += count
+            le = bound if isinstance(bound, str) else repr(bound)
+            lines.append(f'{metric}_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{stage="{name}"}} {stage_snapshot.total!r}')
+        lines.append(f'{metric}_count{{stage="{name}"}} {stage_snapshot.count}')
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def trace(path):
+    """
+    Record every stage inside the block (a single frame) and write them as a Chrome trace-event file
+    Opens in chrome://tracing or Perfetto. Enables recording for the block.
+    """
+    global _trace_events, _enabled
+    was_enabled = _enabled
+    with _lock:
+        _trace_events = []
+    _enabled = True
+    try:
+        yield
+    finally:
+        _enabled = was_enabled
+        with _lock:
+            events, _trace_events = _trace_events, None
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
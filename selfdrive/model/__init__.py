@@ -1,2 +1,2 @@
-from . import speedlimit, base
-__all__ = [speedlimit, base]
\ No newline at end of file
+from . import speedlimit, base, export
+__all__ = [speedlimit, base, export]
\ No newline at end of file
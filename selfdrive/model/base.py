@@ -1,28 +1,53 @@
 import numpy as np
-import requests
-import tensorflow as tf
-from object_detection.utils import config_util
+import contextlib
+import functools
 import glob
-from object_detection.builders import model_builder
-from object_detection.utils import label_map_util
-from object_detection.utils import visualization_utils as viz_utils
-import matplotlib
-import warnings
+import logging
 import os
-from io import BytesIO
-import pkg_resources
-import six
-from PIL import Image
+import time
+from collections import namedtuple
+from .. import metrics
 
-warnings.filterwarnings('ignore')
-matplotlib.use('tkagg')
+logger = logging.getLogger(__name__)
 
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-tf.get_logger().setLevel('ERROR')
-gpus = tf.config.experimental.list_physical_devices('GPU')
-print(gpus)
-for gpu in gpus:
-    tf.config.experimental.set_memory_growth(gpu, True)
+WarmupReport = namedtuple("WarmupReport", ["seconds", "traces", "shapes"])
+# source: "checkpoint", "cache" or "export" (built on this load), stages: {stage: seconds}
+LoadReport = namedtuple("LoadReport", ["seconds", "source", "stages"])
+DETECTION_DTYPE = np.dtype([
+    ("label", "U32"),
+    ("class_id", np.int64),
+    ("score", np.int64),
+    ("box", np.float32, (4,))
+])
+
+
+@functools.lru_cache(maxsize=None)
+def tensorflow():
+    """
+    Import and configure tensorflow on first use, so importing selfdrive stays cheap
+    """
+    import warnings
+    warnings.filterwarnings('ignore')
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    import tensorflow as tf
+    tf.get_logger().setLevel('ERROR')
+    for gpu in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    return tf
+
+
+def label_map_category_index(label_map_path):
+    from object_detection.utils import label_map_util
+    return label_map_util.create_category_index_from_labelmap(label_map_path, use_display_name=True)
+
+
+@contextlib.contextmanager
+def _timed(stages, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
 
 
 def valid_file(func):
@@ -51,22 +76,59 @@ class Model:
     Mainly restores models and detects objects
     """
 
-    def __init__(self, ckpt_path, label_map_path, max_detections, warmup_set=None, ckpt_index=0):
+    def __init__(self, ckpt_path, label_map_path, max_detections, warmup_shapes=None, ckpt_index=0, batch_size=16,
+                 canonical_size=None, cache=None, export=None):
+        """
+        params:
+            [1] ckpt_path: checkpoint directory, with the pipeline configuration
+            [2] label_map_path: labelmap.pbtxt path
+            [3] max_detections: detections allowed by allow_detections
+            [4] warmup_shapes: (batch, height, width, channels) inputs to warm up with
+            [5] ckpt_index: checkpoint version to restore
+            [6] batch_size: max images per detect call in batched detection
+            [7] canonical_size: optional (height, width) every input is resized to inside the graph
+                Boxes are normalized, so they still map onto the original input
+            [8] cache: optional cache.PerceptualCache of get_detections results
+            [9] export: optional export.ExportOptions, runs a cached SavedModel or TFLite export
+                of the checkpoint instead of the restored model. The first load exports it,
+                later loads skip model_builder and the label map parsing
+        Where the startup time went is logged and kept as load_report
+        """
+        start = time.perf_counter()
+        stages = {}
         self.ckpt_path = ckpt_path
         self.label_map_path = label_map_path
         self.pipeline_path = self._find_config()
         self.max_detections = max_detections
-        self.as_tf_model = self._restore_model(ckpt_index)
-        self.category_index = label_map_util.create_category_index_from_labelmap(
-            self.label_map_path,
-            use_display_name=True
-        )
+        self.batch_size = batch_size
+        self.canonical_size = canonical_size
+        self.cache = cache
+        self.export = export
+        self.export_path = None
+        self.as_tf_model = None
+        with _timed(stages, "tensorflow"):
+            tensorflow()
+        if export is None:
+            source = "checkpoint"
+            with _timed(stages, "restore"):
+                self.as_tf_model = self._restore_model(ckpt_index)
+            self._detect_fn = self._trace_detect_fn()
+            with _timed(stages, "category_index"):
+                self.category_index = label_map_category_index(self.label_map_path)
+        else:
+            source, self._detect_fn, self.category_index = self._load_export(ckpt_index, export, stages)
+        self.category_names = category_names(self.category_index)
         self.datasets = []
         self.min_score = .75
         self.num_detections = 0
         self.loaded = False
-        if warmup_set:
-            self._warmup(warmup_set)
+        self.warmup_report = None
+        if warmup_shapes:
+            with _timed(stages, "warmup"):
+                self.warmup_report = self._warmup(warmup_shapes)
+        self.load_report = LoadReport(seconds=time.perf_counter() - start, source=source, stages=stages)
+        logger.info("Model loaded from %s in %.2fs (%s)", source, self.load_report.seconds,
+                    ", ".join("{} {:.2f}s".format(name, seconds) for name, seconds in stages.items()))
 
     @property
     def ckpt_path(self):
@@ -96,18 +158,46 @@ class Model:
             raise ValueError("Value must be at least 2")
         self._max_detections = max_detections
 
-    def _warmup(self, warmup_set):
+    @property
+    def trace_count(self):
+        """
+        Number of concrete functions traced for the detect function so far, 0 for exports
+        """
+        tracing_count = getattr(self._detect_fn, "experimental_get_tracing_count", None)
+        return tracing_count() if tracing_count else 0
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, batch_size):
+        if batch_size < 1:
+            raise ValueError("Value must be at least 1")
+        self._batch_size = batch_size
+
+    def _warmup(self, warmup_shapes):
         """
         Model warmup as ...
         'The TensorFlow runtime has components that are lazily initialized'
+        Runs synthetic frames, no network access needed
+        params:
+            [1] warmup_shapes: (batch, height, width, channels) of the inputs that will run
+        return:
+            WarmupReport
         """
-        for img_url in warmup_set:
-            try:
-                response = requests.get(img_url)
-                img = Image.open(BytesIO(response.content))
-                self.get_detections(np.array(img))
-            except:
-                pass
+        rng = np.random.default_rng(0)
+        traces_before = self.trace_count
+        start = time.perf_counter()
+        for shape in warmup_shapes:
+            self.get_tf_detections_batch(rng.integers(0, 256, size=shape, dtype=np.uint8))
+        report = WarmupReport(
+            seconds=time.perf_counter() - start,
+            traces=self.trace_count - traces_before,
+            shapes=tuple(tuple(shape) for shape in warmup_shapes)
+        )
+        logger.info("Warmup took %.2fs, %d trace(s) for shapes %s", report.seconds, report.traces, report.shapes)
+        return report
 
     def _find_config(self):
         files = glob.glob(os.path.join(self.ckpt_path, "*.config"))
@@ -123,21 +213,78 @@ class Model:
         return:
             detection model object
         """
+        from object_detection.utils import config_util
+        from object_detection.builders import model_builder
+        tf = tensorflow()
         configs = config_util.get_configs_from_pipeline_file(self.pipeline_path)
         detection_model = model_builder.build(model_config=configs['model'], is_training=False)
         ckpt = tf.compat.v2.train.Checkpoint(model=detection_model)
         ckpt.restore(os.path.join(self.ckpt_path, "ckpt-{}".format(index))).expect_partial()
         return detection_model
 
-    @tf.function
-    def _detect_fn(self, image):
+    def _trace_detect_fn(self):
+        tf = tensorflow()
+        # Any batch size and frame size share one traced graph, a shape outside
+        # the signature raises instead of silently retracing
+        return tf.function(
+            self._detect,
+            input_signature=[tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.float32)]
+        )
+
+    def _load_export(self, index, options, stages):
         """
-        Tensorflow function to get postprocess detections
+        Detect function and category index of the export of the i[th] checkpoint,
+        the checkpoint is only restored when the export isn't cached yet
+        Any failure to build or load the export is logged and falls back to the restored checkpoint
+        params:
+            [1] index: checkpoint index
+            [2] options: export.ExportOptions
+            [3] stages: {stage: seconds} the load stages are added to
+        return:
+            (source, detect function, category index)
+        """
+        from . import export
+        export.validate_options(options)
+        try:
+            with _timed(stages, "validate"):
+                cache = export.ExportCache(self.ckpt_path, index, self.pipeline_path, options.cache_dir,
+                                           self.label_map_path, options.validate)
+            source = "cache"
+            if not cache.exists(options, self.canonical_size):
+                source = "export"
+                with _timed(stages, "restore"):
+                    self.as_tf_model = self._restore_model(index)
+                with _timed(stages, "export"):
+                    cache.export(self.as_tf_model, self._detect, options, self.canonical_size)
+            with _timed(stages, "category_index"):
+                category_index = cache.category_index()
+            export_path = cache.artifact_path(options, self.canonical_size)
+            with _timed(stages, "load"):
+                detect_fn = export.load(export_path, options)
+                # Some failures only show on the first call, e.g. select TF ops without a Flex delegate
+                split_tf_detections(detect_fn(tensorflow().zeros(export.PROBE_SHAPE, dtype=tensorflow().float32)))
+        except Exception:
+            # Tracing, saving, converting or a broken cache entry, the model stays usable
+            logger.exception("Can't run the %s export, running the restored checkpoint", options.format)
+            if self.as_tf_model is None:
+                with _timed(stages, "restore"):
+                    self.as_tf_model = self._restore_model(index)
+            with _timed(stages, "category_index"):
+                category_index = label_map_category_index(self.label_map_path)
+            return "checkpoint", self._trace_detect_fn(), category_index
+        self.export_path = export_path
+        return source, detect_fn, category_index
+
+    def _detect(self, image):
+        """
+        Get postprocess detections, traced by tf.function as self._detect_fn
         params:
             [1] image: image array
         return:
             detections
         """
+        if self.canonical_size:
+            image = tensorflow().image.resize(image, self.canonical_size)
         image, shapes = self.as_tf_model.preprocess(image)
         prediction_dict = self.as_tf_model.predict(image, shapes)
         detections = self.as_tf_model.postprocess(prediction_dict, shapes)
@@ -154,14 +301,46 @@ class Model:
         return:
             detections
         """
+        tf = tensorflow()
         input_tensor = tf.convert_to_tensor(np.expand_dims(image_np, 0), dtype=tf.float32)
-        detections = self._detect_fn(input_tensor)
-        num_detections = int(detections.pop('num_detections'))
-        detections = {key: value[0, :num_detections].numpy()
-                      for key, value in detections.items()}
-        detections['num_detections'] = num_detections
-        detections['detection_classes'] = detections['detection_classes'].astype(np.int64)
-        return detections
+        with metrics.stage("model.inference"):
+            detections = self._detect_fn(input_tensor)
+        return split_tf_detections(detections)[0]
+
+    def get_tf_detections_batch(self, images, batch_size=None):
+        """
+        Run many images through the detect function, one call per batch
+        Images are grouped by shape, so every batch is stacked without padding
+        params:
+            [1] images: sequence of image arrays, or an already stacked array
+            [2] batch_size: max images per call (default: self.batch_size)
+        return:
+            list of detections, in the order of images
+        """
+        tf = tensorflow()
+        batch_size = batch_size or self.batch_size
+        if isinstance(images, np.ndarray):
+            # Already stacked, slice the batches without copying
+            ret = []
+            for start in range(0, len(images), batch_size):
+                input_tensor = tf.convert_to_tensor(images[start:start + batch_size], dtype=tf.float32)
+                with metrics.stage("model.inference"):
+                    detections = self._detect_fn(input_tensor)
+                ret.extend(split_tf_detections(detections))
+            return ret
+        groups = {}
+        for i, image_np in enumerate(images):
+            groups.setdefault(np.shape(image_np), []).append(i)
+        ret = [None] * len(images)
+        for indices in groups.values():
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                input_tensor = tf.convert_to_tensor(np.stack([images[i] for i in batch]), dtype=tf.float32)
+                with metrics.stage("model.inference"):
+                    batch_detections = self._detect_fn(input_tensor)
+                for i, detections in zip(batch, split_tf_detections(batch_detections)):
+                    ret[i] = detections
+        return ret
 
     def get_detections(self, image_np, tf_detections=None):
         """
@@ -171,22 +350,67 @@ class Model:
             [1] image array
         return:
             detections dictionary
+        With a cache, an image close to an earlier one gets a copy of its result without inference
         """
+        if not tf_detections and self.cache is not None:
+            # Images without a detection aren't stored, a sign appearing in them barely changes the hash
+            ret = self.cache.get_or_compute(image_np, lambda: self._get_detections(image_np), tag="detections",
+                                            store=has_detections)
+            ret = dict(ret) if ret else ret
+        else:
+            ret = self._get_detections(image_np, tf_detections)
+        if ret:
+            self.num_detections += len(ret)
+        return ret
+
+    def _get_detections(self, image_np, tf_detections=None):
         if not tf_detections:
             detections = self.get_tf_detections(image_np)
         else:
             detections = tf_detections
         label_id_offset = 1
-        ret = process_tf_detections(
+        return process_tf_detections(
             boxes=detections['detection_boxes'],
             classes=detections['detection_classes'] + label_id_offset,
             scores=detections['detection_scores'],
-            category_index=self.category_index,
+            category_index=self.category_names,
+            min_score_thresh=self.min_score
+        )
+
+    def get_detection_array(self, image_np, tf_detections=None):
+        """
+        Get detections above the score threshold as a DETECTION_DTYPE structured array
+        params:
+            [1] image array
+        return:
+            structured array, one row per detection
+        """
+        if not tf_detections:
+            detections = self.get_tf_detections(image_np)
+        else:
+            detections = tf_detections
+        label_id_offset = 1
+        ret = process_tf_detections_array(
+            boxes=detections['detection_boxes'],
+            classes=detections['detection_classes'] + label_id_offset,
+            scores=detections['detection_scores'],
+            category_index=self.category_names,
             min_score_thresh=self.min_score
         )
         self.num_detections += len(ret)
         return ret
 
+    def get_detections_batch(self, images, batch_size=None):
+        """
+        get_detections for many images, with a batched detect function call
+        return:
+            list of detections dictionaries, in the order of images
+        """
+        return [
+            self.get_detections(image_np, tf_detections=detections)
+            for image_np, detections in zip(images, self.get_tf_detections_batch(images, batch_size))
+        ]
+
     def get_image_np_with_detections(self, image_np, tf_detections=None):
         """
 
@@ -195,6 +419,9 @@ class Model:
             detections = self.get_tf_detections(image_np)
         else:
             detections = tf_detections
+        import matplotlib
+        matplotlib.use('tkagg')
+        from object_detection.utils import visualization_utils as viz_utils
         label_id_offset = 1
         image_np_with_detections = image_np.copy()
         viz_utils.visualize_boxes_and_labels_on_image_array(
@@ -210,13 +437,116 @@ class Model:
         return image_np_with_detections
 
 
+def has_detections(detections):
+    """
+    Whether a get_detections dictionary holds a detection above the score threshold
+    """
+    return bool(detections) and any(label != "None" for label in detections)
+
+
 def detection_model_path(name, version):
+    import pkg_resources
     ckpt_path = pkg_resources.resource_filename('selfdrive.model', f'object_detection\\{name}\\v{version}\\checkpoint')
     if os.path.isdir(ckpt_path):
         return ckpt_path
     raise FileNotFoundError(ckpt_path)
 
 
+@metrics.timed("model.split_detections")
+def split_tf_detections(detections):
+    """
+    Split batched postprocessed detections into a numpy dict per image
+    params:
+        [1] detections: the detect function output
+    return:
+        list of detections
+    """
+    # Tensors of the traced function, arrays of a TFLite export
+    detections = {key: np.asarray(value) for key, value in detections.items()}
+    num_detections = detections.pop('num_detections').astype(np.int64)
+    ret = []
+    for i, count in enumerate(num_detections.tolist()):
+        image_detections = {key: value[i, :count] for key, value in detections.items()}
+        image_detections['num_detections'] = count
+        image_detections['detection_classes'] = image_detections['detection_classes'].astype(np.int64)
+        ret.append(image_detections)
+    return ret
+
+
+def non_max_suppression(boxes, scores, iou_threshold=.5):
+    """
+    Greedy non-max suppression
+    params:
+        [1] boxes: (N, 4) array of (ymin, xmin, ymax, xmax)
+        [2] scores: (N,) array
+        [3] iou_threshold: drop boxes overlapping a better one by more than this
+    return:
+        indices of the kept boxes, best score first
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    ymin, xmin, ymax, xmax = boxes.T
+    areas = (ymax - ymin) * (xmax - xmin)
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while len(order) > 0:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        height = np.clip(np.minimum(ymax[best], ymax[rest]) - np.maximum(ymin[best], ymin[rest]), 0, None)
+        width = np.clip(np.minimum(xmax[best], xmax[rest]) - np.maximum(xmin[best], xmin[rest]), 0, None)
+        intersection = height * width
+        iou = intersection / np.maximum(areas[best] + areas[rest] - intersection, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def category_names(category_index):
+    """
+    Class names as an array indexed by class id, 'N/A' for ids missing from the labelmap
+    params:
+        [1] category_index: {id: {'name': str}}
+    """
+    ids = [class_id for class_id in category_index if class_id >= 0]
+    names = np.full(max(ids, default=-1) + 1, 'N/A', dtype=object)
+    for class_id in ids:
+        names[class_id] = str(category_index[class_id]['name'])
+    return names.astype(str)
+
+
+@metrics.timed("model.process_detections")
+def process_tf_detections_array(
+        boxes,
+        classes,
+        scores,
+        category_index,
+        min_score_thresh=.5,
+        agnostic_mode=False):
+    """
+    Vectorized detections above min_score_thresh
+    params:
+        [1] boxes, classes, scores: detections arrays
+        [2] category_index: labelmap dict, or category_names() of it
+        [3] agnostic_mode: leave the labels empty
+    return:
+        DETECTION_DTYPE structured array (label, class_id, score, box), in detection order
+    """
+    if scores is None:
+        return np.empty(0, dtype=DETECTION_DTYPE)
+    hits = np.flatnonzero(np.asarray(scores) > min_score_thresh)
+    ret = np.empty(len(hits), dtype=DETECTION_DTYPE)
+    class_ids = np.asarray(classes)[hits].astype(np.int64)
+    ret['class_id'] = class_ids
+    ret['score'] = np.rint(100 * np.asarray(scores)[hits]).astype(np.int64)
+    ret['box'] = np.asarray(boxes)[hits]
+    if agnostic_mode:
+        ret['label'] = ''
+    else:
+        names = category_index if isinstance(category_index, np.ndarray) else category_names(category_index)
+        known = (class_ids >= 0) & (class_ids < len(names))
+        ret['label'] = 'N/A'
+        ret['label'][known] = names[class_ids[known]]
+    return ret
+
+
 def process_tf_detections(
         boxes,
         classes,
@@ -225,25 +555,28 @@ def process_tf_detections(
         min_score_thresh=.5,
         agnostic_mode=False):
     """
+    Compatibility adapter over process_tf_detections_array
+    A label keeps its last detection, and every box under the threshold goes to "None"
       Returns:
          Dict {
             label->[str]: (score->[int], box->[tuple])
          }
       """
+    if boxes.shape[0] == 0:
+        return None
+    hits = process_tf_detections_array(boxes, classes, scores, category_index, min_score_thresh, agnostic_mode)
+    keys = np.full(boxes.shape[0], "None", dtype=object)
+    values = np.zeros(boxes.shape[0], dtype=np.int64)
+    if scores is not None and not agnostic_mode:
+        above = np.flatnonzero(np.asarray(scores) > min_score_thresh)
+        keys[above] = hits['label']
+        values[above] = hits['score']
+    keys = keys.astype(str)
+    # dict order follows a key's first detection, its value the last one
+    _, first = np.unique(keys, return_index=True)
+    _, last_reversed = np.unique(keys[::-1], return_index=True)
+    last = boxes.shape[0] - 1 - last_reversed
     detections = {}
-    count = 0
-    for i in range(boxes.shape[0]):
-        box = tuple(boxes[i].tolist())
-        display_str, score = "None", 0
-        if scores is not None and scores[i] > min_score_thresh:
-            if not agnostic_mode:
-                if classes[i] in six.viewkeys(category_index):
-                    class_name = category_index[classes[i]]['name']
-                else:
-                    class_name = 'N/A'
-                display_str = str(class_name)
-                score = int(round(100 * scores[i]))
-        detections[display_str] = (score, box)
-        count += 1
-    if count:
-        return detections
+    for i, j in sorted(zip(first.tolist(), last.tolist())):
+        detections[str(keys[i])] = (int(values[j]), tuple(boxes[j].tolist()))
+    return detections
@@ -0,0 +1,336 @@
+"""
+Exported inference backends of a detection model
+
+Restoring a checkpoint rebuilds the network from its pipeline config with model_builder
+and runs the eager-traced detect function, heavy on CPU-only nodes. The detect function
+is exported once, as a SavedModel or a (quantized) TFLite model, into a cache directory
+named after a hash of the checkpoint files, with the category index of the label map.
+Later loads read both straight from the cache, without object_detection.
+
+    model = speedlimit.Model()
+    model.load_self(export=ExportOptions("tflite", quantization="dynamic"))
+
+Exports keep the float32 input and the detection outputs of the detect function, so
+get_detections and SpeedLimitScanner work the same on every backend.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+import numpy as np
+from .base import tensorflow
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("saved_model", "tflite")
+# float32 keeps the float model, float16 halves the weights, dynamic stores int8 weights,
+# int8 also quantizes activations from representative images
+QUANTIZATIONS = ("float32", "float16", "dynamic", "int8")
+# Outputs read by split_tf_detections, the raw and multiclass outputs are not exported
+OUTPUT_KEYS = ("detection_boxes", "detection_scores", "detection_classes", "num_detections")
+INPUT_NAME = "images"
+# Input of the inference an export must run before it replaces the checkpoint
+PROBE_SHAPE = (1, 64, 64, 3)
+CATEGORY_INDEX_NAME = "category_index.json"
+# mtime trusts unchanged sizes and modification times, hash reads every file on every load
+VALIDATIONS = ("mtime", "hash")
+CACHE_DIR = os.environ.get(
+    "SELFDRIVE_MODEL_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "selfdrive", "models")
+)
+
+ExportOptions = namedtuple(
+    "ExportOptions",
+    ["format", "quantization", "cache_dir", "num_threads", "representative_images", "validate"],
+    defaults=("float32", None, None, None, "mtime")
+)
+# The float graph of the checkpoint, the default backend of speedlimit.Model.load_self
+SAVED_MODEL = ExportOptions("saved_model")
+
+
+def checkpoint_files(ckpt_path, index, pipeline_path, label_map_path=None):
+    """
+    Files that define a restored model: the ckpt-{index} index and data shards,
+    the pipeline config and the label map
+    """
+    prefix = os.path.join(ckpt_path, "ckpt-{}".format(index))
+    files = sorted(glob.glob(prefix + ".index") + glob.glob(prefix + ".data-*"))
+    if not files:
+        raise FileNotFoundError("No ckpt-{} checkpoint inside {}".format(index, ckpt_path))
+    return files + [pipeline_path] + ([label_map_path] if label_map_path else [])
+
+
+def checkpoint_hash(files, chunk_size=1 << 20):
+    """
+    sha256 hex digest of the names and contents of files
+    """
+    digest = hashlib.sha256()
+    for name in files:
+        digest.update(os.path.basename(name).encode())
+        with open(name, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stats(files):
+    """
+    {absolute path: [size, mtime in ns]} of files
+    """
+    ret = {}
+    for name in files:
+        stat = os.stat(name)
+        ret[os.path.abspath(name)] = [stat.st_size, stat.st_mtime_ns]
+    return ret
+
+
+def validate_options(options: ExportOptions):
+    if options.format not in FORMATS:
+        raise ValueError("Export format must be one of {}".format(FORMATS))
+    if options.quantization not in QUANTIZATIONS:
+        raise ValueError("Quantization must be one of {}".format(QUANTIZATIONS))
+    if options.format == "saved_model" and options.quantization != "float32":
+        raise ValueError("Only TFLite exports can be quantized")
+    if options.validate not in VALIDATIONS:
+        raise ValueError("Validation must be one of {}".format(VALIDATIONS))
+
+
+def _publish(build, path):
+    """
+    Build an artifact inside a temporary sibling of path, then rename it into place
+    Workers starting together may all build it, a reader never sees a partial export
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        target = os.path.join(tmp, os.path.basename(path))
+        build(target)
+        try:
+            os.rename(target, path)
+        except OSError:
+            # Another worker published it first
+            if not os.path.exists(path):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _write_json(value):
+    def build(target):
+        with open(target, "w") as f:
+            json.dump(value, f)
+
+    return build
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def export_saved_model(detection_model, detect, path):
+    """
+    Save a detect function for any batch and frame size
+    params:
+        [1] detection_model: the restored model, its variables are saved with the function
+        [2] detect: float32 (batch, height, width, 3) -> postprocessed detections function
+        [3] path: SavedModel directory to create
+    """
+    tf = tensorflow()
+    module = tf.Module()
+    module.detection_model = detection_model
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.float32, name=INPUT_NAME)])
+    def serve(images):
+        detections = detect(images)
+        return {key: detections[key] for key in OUTPUT_KEYS}
+
+    module.detect = serve
+    tf.saved_model.save(module, path, signatures={"serving_default": serve})
+
+
+def convert_tflite(saved_model_path, path, quantization="float32", representative_images=None):
+    """
+    Convert an export_saved_model SavedModel to a TFLite flatbuffer
+    Preprocessing and non-max suppression have no builtin TFLite kernels, they run as
+    select TF ops, the interpreter needs the Flex delegate linked (tf.lite of TF 2.21
+    doesn't, the model then falls back to the checkpoint). The input and outputs stay
+    float32 whatever the quantization.
+    params:
+        [1] saved_model_path: export_saved_model directory
+        [2] path: .tflite file to create
+        [3] quantization: one of QUANTIZATIONS
+        [4] representative_images: (height, width, 3) images calibrating int8 activations,
+            frames like the ones the model will see
+    """
+    tf = tensorflow()
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_path)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if quantization != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if representative_images is None:
+            raise ValueError("int8 quantization needs representative images")
+
+        def representative_dataset():
+            for image in representative_images:
+                yield [np.asarray(image, dtype=np.float32)[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+
+class ExportCache:
+    """
+    Exports of one checkpoint, under cache_dir/<checkpoint hash>/
+    A changed checkpoint, pipeline config or label map gets a new hash, so stale exports
+    are never loaded. The hash of every checkpoint is remembered under cache_dir/checkpoints/
+    with the sizes and mtimes of its files, while they match it isn't computed again.
+    """
+
+    def __init__(self, ckpt_path, index, pipeline_path, cache_dir=None, label_map_path=None, validate="mtime"):
+        """
+        params:
+            [1] ckpt_path, index: checkpoint directory and the ckpt-{index} version
+            [2] pipeline_path: pipeline config of the checkpoint
+            [3] cache_dir: exports root, SELFDRIVE_MODEL_CACHE or ~/.cache/selfdrive/models if None
+            [4] label_map_path: label map of the cached category index
+            [5] validate: "mtime" reuses the remembered hash of unchanged files,
+                "hash" hashes them again (a copy keeping sizes and mtimes can't fool it)
+        """
+        cache_dir = cache_dir or CACHE_DIR
+        self.files = checkpoint_files(ckpt_path, index, pipeline_path, label_map_path)
+        self.label_map_path = label_map_path
+        self.hashed = False
+        stats = file_stats(self.files)
+        key = hashlib.sha1(os.path.abspath(self.files[0]).encode()).hexdigest()[:16]
+        self.manifest_path = os.path.join(cache_dir, "checkpoints", key + ".json")
+        manifest = _read_json(self.manifest_path) if validate == "mtime" else None
+        if manifest and manifest.get("files") == stats:
+            self.digest = manifest["digest"]
+        else:
+            self.digest = checkpoint_hash(self.files)
+            self.hashed = True
+            try:
+                _publish(_write_json({"files": stats, "digest": self.digest}), self.manifest_path)
+            except OSError as e:
+                logger.warning("Can't write %s: %s", self.manifest_path, e)
+        self.path = os.path.join(cache_dir, self.digest[:16])
+
+    @staticmethod
+    def _suffix(canonical_size):
+        # canonical_size resizes inside the exported graph, it's part of the export
+        return "-{}x{}".format(*canonical_size) if canonical_size else ""
+
+    def saved_model_path(self, canonical_size=None):
+        return os.path.join(self.path, "saved_model" + self._suffix(canonical_size))
+
+    def artifact_path(self, options: ExportOptions, canonical_size=None):
+        if options.format == "saved_model":
+            return self.saved_model_path(canonical_size)
+        return os.path.join(self.path, "{}{}.tflite".format(options.quantization, self._suffix(canonical_size)))
+
+    @property
+    def category_index_path(self):
+        return os.path.join(self.path, CATEGORY_INDEX_NAME)
+
+    def exists(self, options: ExportOptions, canonical_size=None):
+        return os.path.exists(self.artifact_path(options, canonical_size))
+
+    def category_index(self):
+        """
+        Category index of the label map, read from the cache, built and cached on a miss
+        """
+        category_index = _read_json(self.category_index_path)
+        if category_index is None:
+            from .base import label_map_category_index
+            category_index = label_map_category_index(self.label_map_path)
+            _publish(_write_json(category_index), self.category_index_path)
+            return category_index
+        # JSON keys are strings
+        return {int(class_id): category for class_id, category in category_index.items()}
+
+    def export(self, detection_model, detect, options: ExportOptions, canonical_size=None):
+        """
+        Build the missing exports of options, a TFLite export is converted from the SavedModel
+        params:
+            [1] detection_model, detect: as in export_saved_model
+            [2] options: ExportOptions
+            [3] canonical_size: the (height, width) detect resizes to, None if it doesn't
+        return:
+            path of the artifact
+        """
+        validate_options(options)
+        saved_model_path = self.saved_model_path(canonical_size)
+        if not os.path.exists(saved_model_path):
+            _publish(lambda target: export_saved_model(detection_model, detect, target), saved_model_path)
+            logger.info("Exported SavedModel to %s", saved_model_path)
+        path = self.artifact_path(options, canonical_size)
+        if not os.path.exists(path):
+            _publish(
+                lambda target: convert_tflite(saved_model_path, target, options.quantization,
+                                              options.representative_images),
+                path
+            )
+            logger.info("Converted %s TFLite model to %s", options.quantization, path)
+        return path
+
+
+class SavedModelDetector:
+    """
+    Detect function of a SavedModel export, called like the traced tf.function
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._module = tensorflow().saved_model.load(path)
+
+    def __call__(self, images):
+        return self._module.detect(images)
+
+
+class TFLiteDetector:
+    """
+    Detect function of a TFLite export, called like the traced tf.function
+    The input is resized to every new batch and frame shape. An interpreter
+    isn't thread safe, concurrent calls run one at a time.
+    """
+
+    def __init__(self, path, num_threads=None):
+        """
+        params:
+            [1] path: .tflite file
+            [2] num_threads: interpreter threads, os.cpu_count() if None
+        """
+        self.path = path
+        self.num_threads = num_threads or os.cpu_count() or 1
+        tf = tensorflow()
+        self._interpreter = tf.lite.Interpreter(model_path=path, num_threads=self.num_threads)
+        self._runner = self._interpreter.get_signature_runner("serving_default")
+        self._lock = threading.Lock()
+
+    def __call__(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            return self._runner(**{INPUT_NAME: images})
+
+
+def load(path, options: ExportOptions):
+    """
+    Detect function of an exported artifact
+    """
+    if options.format == "saved_model":
+        return SavedModelDetector(path)
+    return TFLiteDetector(path, options.num_threads)
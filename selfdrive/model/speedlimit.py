@@ -1,11 +1,25 @@
 import os
+import numpy as np
+from collections import namedtuple
 from .base import Model as Base
-from .base import detection_model_path
+from .base import detection_model_path, non_max_suppression
+from .exceptions import EmptyModel
+from .export import SAVED_MODEL
+from ..image.editor import CircleProposer, search_area_tiles
+from ..image.filters import CROP_SPEEDLIMIT_SCREEN, CROP_SPEEDLIMIT_AREA
+from ..cache import PerceptualCache
 
 VERSION = 3
 NAME = "speedlimit"
 LABELMAP_NAME = "labelmap.pbtxt"
 MAX_DETECTIONS = 10
+# A single search area, and every search area of a frame in one SpeedLimitScanner batch
+WARMUP_SHAPES = (
+    (1,) + CROP_SPEEDLIMIT_AREA.size + (3,),
+    (len(CROP_SPEEDLIMIT_AREA.cords),) + CROP_SPEEDLIMIT_AREA.size + (3,)
+)
+
+SignDetection = namedtuple("SignDetection", ["label", "score", "box"])
 
 
 class Model(Base):
@@ -13,16 +27,113 @@ class Model(Base):
         self.path = detection_model_path(NAME, VERSION)
         self.loaded = False
 
-    def load_self(self):
+    def load_self(self, canonical_size=None, cache=None, export=SAVED_MODEL):
+        """
+        Load the cached SavedModel export of the checkpoint, built on the first load,
+        the checkpoint is restored when it fails. export=None always restores the checkpoint,
+        a TFLite export is opt-in, compare it with bench backends first
+        """
         super().__init__(
             ckpt_path=self.path,
             label_map_path=os.path.join(self.path, LABELMAP_NAME),
             max_detections=MAX_DETECTIONS,
-            warmup_set=[
-                "https://i.postimg.cc/BZzHPrL5/Limit-4bff52ca-7a12-11ec-99d4-a44cc849d7a3.jpg",
-                "https://i.postimg.cc/xTbHv6Mw/Limit-4c0bf458-7a12-11ec-b25b-a44cc849d7a3.jpg",
-                "https://i.postimg.cc/RZ5tXwTN/Limit-4c1c25ac-7a12-11ec-8acd-a44cc849d7a3.jpg"
-            ]
-
+            warmup_shapes=WARMUP_SHAPES,
+            canonical_size=canonical_size,
+            cache=cache,
+            export=export
         )
         self.loaded = True
+
+
+class SpeedLimitScanner:
+    """
+    Searches a frame for speed-limit signs with a single batched model call
+    Every search area is detected at once, its boxes are mapped back to the frame,
+    and hits of overlapping areas are merged with non-max suppression.
+    With a CircleProposer only the crops around red-rimmed circles are detected,
+    and frames without a candidate never reach the model. With a PerceptualCache,
+    tiles close to an earlier tile reuse its detections.
+    """
+
+    def __init__(self, model: Model, screen=CROP_SPEEDLIMIT_SCREEN, area=CROP_SPEEDLIMIT_AREA, iou_threshold=.3,
+                 proposer: CircleProposer = None, cache: PerceptualCache = None):
+        self.model = model
+        self.cache = cache
+        self.screen = screen
+        self.area = area
+        self.iou_threshold = iou_threshold
+        self.proposer = proposer
+        self.skipped_frames = 0
+
+    def _detect_tiles(self, tiles):
+        """
+        get_tf_detections_batch, only the tiles missing from the cache are detected
+        Detection boxes are normalized to their tile, so a cached result fits any tile position.
+        Tiles without a detection aren't stored: a small sign entering an empty tile
+        barely changes its hash, it would hit the empty result until it expires
+        """
+        if self.cache is None:
+            return self.model.get_tf_detections_batch(tiles)
+        fingerprints = [self.cache.fingerprint(tile) for tile in tiles]
+        ret = [self.cache.get(fingerprint, tag="speedlimit") for fingerprint in fingerprints]
+        missing = [i for i, detections in enumerate(ret) if detections is None]
+        if missing:
+            for i, detections in zip(missing, self.model.get_tf_detections_batch(tiles[missing])):
+                ret[i] = detections
+                if (detections['detection_scores'] > self.model.min_score).any():
+                    self.cache.put(fingerprints[i], detections, tag="speedlimit")
+        return ret
+
+    def scan(self, frame):
+        """
+        params:
+            [1] frame: full camera frame
+        return:
+            list of SignDetection, boxes as frame pixels (ymin, xmin, ymax, xmax), best score first
+        """
+        if not self.model.loaded:
+            raise EmptyModel()
+        top, left = 0, 0
+        image = frame
+        if self.screen.crop:
+            top, bottom, left, right = self.screen.crop
+            image = frame[top:bottom, left:right]
+
+        if self.proposer:
+            candidates = self.proposer.propose(image)
+            if not candidates:
+                self.skipped_frames += 1
+                return []
+            tiles = np.stack([candidate.crop for candidate in candidates])
+            # (top, left, height, width) of every tile inside image
+            areas = [(y1, x1, y2 - y1, x2 - x1) for y1, x1, y2, x2 in (candidate.box for candidate in candidates)]
+        else:
+            tiles = search_area_tiles(image, self.area.size, self.area.cords)
+            areas = [(y, x) + tuple(self.area.size) for y, x in self.area.cords]
+        label_id_offset = 1
+        boxes, scores, classes = [], [], []
+        for (y, x, height, width), detections in zip(areas, self._detect_tiles(tiles)):
+            hits = detections['detection_scores'] > self.model.min_score
+            if not hits.any():
+                continue
+            scale = np.array([height, width, height, width])
+            offset = np.array([y + top, x + left, y + top, x + left])
+            boxes.append(detections['detection_boxes'][hits] * scale + offset)
+            scores.append(detections['detection_scores'][hits])
+            classes.append(detections['detection_classes'][hits] + label_id_offset)
+        if not boxes:
+            return []
+
+        boxes, scores, classes = np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes)
+        ret = []
+        for class_id in np.unique(classes):
+            same_class = np.flatnonzero(classes == class_id)
+            keep = same_class[non_max_suppression(boxes[same_class], scores[same_class], self.iou_threshold)]
+            name = str(self.model.category_index.get(int(class_id), {'name': 'N/A'})['name'])
+            ret.extend(
+                SignDetection(label=name, score=int(round(100 * scores[i])), box=tuple(int(v) for v in boxes[i].round()))
+                for i in keep
+            )
+        ret.sort(key=lambda detection: detection.score, reverse=True)
+        self.model.num_detections += len(ret)
+        return ret
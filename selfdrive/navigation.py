@@ -1,19 +1,29 @@
-import statistics
+import functools
 import math
 import cv2
 import numpy as np
 from collections import namedtuple
 from typing import List
+from . import metrics
 
 Range = namedtuple("Range", ["lower", "upper"])
 Point = namedtuple("Point", ["x", "y"])
 Line = namedtuple("Line", ["pt1", "pt2", "slope"])
 Rectangle = namedtuple("Rectangle", ["pt1", "pt2"])
 NavScores = namedtuple("NavScores", ["forward", "right_count", "right_score", "left_count", "left_score"])
+LineArray = namedtuple("LineArray", ["segments", "slopes", "mean_slope"])
+RegionGeometry = namedtuple("RegionGeometry", ["vertices", "mask", "box", "window"])
 
+# Frame size (width, height) the pixel constants below were tuned for,
+# process_lines and scaled LaneDetectors rescale them to the actual frame size
+REFERENCE_SIZE = (800, 600)
 RIGHT_MAX_VALUE = 350
 LEFT_MAX_VALUE = 800
 
+# Padding around the ROI bounding box when LaneDetector crops,
+# keeps Canny's gradients and non-maximum suppression intact at the ROI border
+CANNY_MARGIN = 16
+
 
 class Masks:
     yellow = Range(lower=[22, 93, 0], upper=[30, 255, 255])
@@ -42,6 +52,62 @@ def get_steer_adjust_region(width, height) -> List:
     ]
 
 
+REGIONS = {
+    "turn": get_turn_detection_region,
+    "steer": get_steer_adjust_region
+}
+
+
+@functools.lru_cache(maxsize=64)
+def _region_geometry(shape, dtype, polygons):
+    """
+    polygons: ((shape, int32 bytes), ...) of the vertices, a single (polygons, N, 2) array,
+    or one (N, 2) array per polygon when their point counts differ
+    """
+    arrays = [np.frombuffer(data, dtype=np.int32).reshape(vertices_shape) for vertices_shape, data in polygons]
+    vertices = arrays[0] if len(arrays) == 1 else arrays
+    mask = np.zeros(shape, dtype=dtype)
+    cv2.fillPoly(mask, vertices, 255)
+    raster = mask if mask.ndim == 2 and mask.dtype == np.uint8 else (mask.reshape(shape[:2] + (-1,))[..., 0] != 0)
+    x, y, w, h = cv2.boundingRect(raster.astype(np.uint8, copy=False))
+    mask.setflags(write=False)
+    return RegionGeometry(
+        vertices=vertices,
+        mask=mask,
+        box=Rectangle(pt1=Point(x=x, y=y), pt2=Point(x=x + w, y=y + h)),
+        window=(slice(y, y + h), slice(x, x + w))
+    )
+
+
+def region_geometry(width, height, region, dtype="uint8", channels=None) -> RegionGeometry:
+    """
+    Rasterized region of interest, built once per frame geometry and shared (LRU cached)
+    params:
+        [1] width, height: frame size
+        [2] region: a REGIONS name, or polygon vertices as passed to detect_lanes
+        [3] dtype, channels: type of the mask, a single channel mask if channels is None
+    return:
+        RegionGeometry, read-only vertices (polygons, N, 2) and mask, the mask's bounding box
+        and the matching (rows, columns) slices. Polygons with different point counts keep
+        a list of (N, 2) vertices, as cv2.fillPoly takes them
+    """
+    if isinstance(region, str):
+        region = REGIONS[region](width, height)
+    try:
+        vertices = np.asarray(region, dtype=np.int32)
+    except (ValueError, TypeError):
+        # Polygons with different point counts can't be stacked, each one is a part of the key
+        polygons = tuple(np.asarray(polygon, dtype=np.int32).reshape(-1, 2) for polygon in region)
+    else:
+        if vertices.ndim == 2:
+            vertices = vertices[np.newaxis]
+        polygons = (vertices,)
+    shape = (height, width) if channels is None else (height, width, channels)
+    return _region_geometry(shape, np.dtype(dtype).str,
+                            tuple((polygon.shape, polygon.tobytes()) for polygon in polygons))
+
+
+@functools.lru_cache(maxsize=64)
 def get_non_zero_rectangle(width, height, direction) -> Rectangle:
     if direction == Directions.right:
         return Rectangle(
@@ -65,55 +131,217 @@ def mask_img(img, mask: Range):
 
 
 def crop_region_of_interest(img, vertices):
-    mask = np.zeros_like(img)
-    match_mask_color = 255
-    cv2.fillPoly(mask, vertices, match_mask_color)
+    height, width = img.shape[:2]
+    channels = img.shape[2] if img.ndim == 3 else None
+    mask = region_geometry(width, height, vertices, img.dtype, channels).mask
     masked_image = cv2.bitwise_and(img, mask)
     return masked_image
 
 
 def detect_lanes(img, mask: Range, vertices):
-    masked = mask_img(img, mask)
-    canny_img = cv2.Canny(masked, 100, 200)
-    cropped_image = crop_region_of_interest(
-        img=canny_img,
-        vertices=np.array([vertices], np.int32)
-    )
-    lines = cv2.HoughLinesP(cropped_image,
-                            rho=6,
-                            theta=np.pi / 180,
-                            threshold=160,
-                            lines=np.array([]),
-                            minLineLength=20,
-                            maxLineGap=100)
+    with metrics.stage("navigation.mask"):
+        masked = mask_img(img, mask)
+    with metrics.stage("navigation.canny"):
+        canny_img = cv2.Canny(masked, 100, 200)
+    with metrics.stage("navigation.roi"):
+        cropped_image = crop_region_of_interest(
+            img=canny_img,
+            vertices=np.array([vertices], np.int32)
+        )
+    with metrics.stage("navigation.hough"):
+        lines = hough_lines(cropped_image)
     return lines, masked
 
 
-def filter_lines(lines, min_slope=None):
+def hough_lines(edges, scale=1.0):
+    """
+    detect_lanes' cv2.HoughLinesP, with the pixel parameters scaled for an image resized by scale
+    """
+    return cv2.HoughLinesP(edges,
+                           rho=6 * scale,
+                           theta=np.pi / 180,
+                           threshold=max(int(round(160 * scale)), 1),
+                           lines=np.array([]),
+                           minLineLength=20 * scale,
+                           maxLineGap=100 * scale)
+
+
+class LaneDetector:
+    """
+    Stateful version of detect_lanes for a fixed frame size and region of interest
+    The ROI mask and HSV bounds are built once, and every stage writes into
+    preallocated buffers instead of allocating new frames.
+    With scale < 1 detection runs on a downscaled copy of the frame, e.g. a 1080p
+    camera at .5 costs about as much as a 540p one.
+    """
+
+    def __init__(self, width, height, vertices, mask: Range = Masks.yellow, crop=False, margin=CANNY_MARGIN,
+                 scale=1.0):
+        """
+        params:
+            [1] width, height: frame size
+            [2] vertices: ROI polygon, as passed to detect_lanes
+            [3] mask: HSV range of the lanes
+            [4] crop: run color conversion and Canny only inside the ROI bounding box,
+                padded by margin. Canny's hysteresis can't follow weak edges outside
+                that window, and the masked image is left black outside of it.
+            [5] scale: detection resolution relative to the frame. Hough's pixel parameters
+                are scaled with it and lines are mapped back to frame coordinates, the
+                masked image stays at the detection size.
+        """
+        if not 0 < scale <= 1:
+            raise ValueError("Scale must be in (0, 1]")
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.detect_size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+        self.vertices = np.array([vertices], np.int32)
+        self._lower = np.array(mask.lower, dtype="uint8")
+        self._upper = np.array(mask.upper, dtype="uint8")
+
+        width, height = self.detect_size
+        geometry = region_geometry(width, height, np.rint(self.vertices * scale))
+        pt1, pt2 = geometry.box
+        self._empty = pt1 == pt2
+        if crop:
+            self.window = (
+                slice(max(pt1.y - margin, 0), min(pt2.y + margin, height)),
+                slice(max(pt1.x - margin, 0), min(pt2.x + margin, width))
+            )
+        else:
+            self.window = (slice(0, height), slice(0, width))
+        self._roi = geometry.mask[self.window]
+
+        window_shape = self._roi.shape
+        self._hsv = np.empty(window_shape + (3,), dtype="uint8")
+        self._in_range = np.empty(window_shape, dtype="uint8")
+        self._edges = np.zeros((height, width), dtype="uint8")
+        self._small = None
+        self._masked = None
+        # OpenCV's INTER_AREA is only fast for integer factors, linear is 10x faster otherwise
+        self._interpolation = cv2.INTER_AREA if (1 / scale).is_integer() else cv2.INTER_LINEAR
+
+    def _resized(self, img):
+        if img.shape[:2] != (self.height, self.width):
+            raise ValueError(f"Expected a {self.width}x{self.height} frame, got {img.shape[1]}x{img.shape[0]}")
+        if self.scale == 1:
+            return img
+        width, height = self.detect_size
+        if self._small is None or self._small.shape[2:] != img.shape[2:] or self._small.dtype != img.dtype:
+            self._small = np.empty((height, width) + img.shape[2:], dtype=img.dtype)
+        return cv2.resize(img, self.detect_size, dst=self._small, interpolation=self._interpolation)
+
+    def _masked_buffer(self, img):
+        if self._masked is None or self._masked.shape != img.shape or self._masked.dtype != img.dtype:
+            self._masked = np.zeros_like(img)
+        return self._masked
+
+    def mask_img(self, img):
+        """
+        Same as mask_img(img, mask), written into the detector's buffer, at the detection size
+        """
+        img = self._resized(img)
+        masked = self._masked_buffer(img)
+        src = img[self.window]
+        dst = masked[self.window]
+        cv2.cvtColor(src, cv2.COLOR_BGR2HSV, dst=self._hsv)
+        cv2.inRange(self._hsv, self._lower, self._upper, dst=self._in_range)
+        # Masked bitwise_and leaves dst untouched where the mask is zero
+        dst.fill(0)
+        cv2.bitwise_and(src, src, dst=dst, mask=self._in_range)
+        return masked
+
+    def detect(self, img):
+        """
+        Same as detect_lanes(img, mask, vertices)
+        The returned masked image is overwritten by the next call, copy it to keep it
+        return:
+            lines, masked
+        """
+        with metrics.stage("navigation.mask"):
+            masked = self.mask_img(img)
+        if self._empty:
+            return None, masked
+        edges = self._edges[self.window]
+        with metrics.stage("navigation.canny"):
+            cv2.Canny(masked[self.window], 100, 200, edges=edges)
+        with metrics.stage("navigation.roi"):
+            cv2.bitwise_and(edges, self._roi, dst=edges)
+        with metrics.stage("navigation.hough"):
+            lines = hough_lines(self._edges, self.scale)
+        if lines is not None and self.scale != 1:
+            lines = np.rint(lines / self.scale).astype(lines.dtype)
+        return lines, masked
+
+    def count_lane_pixels(self, rectangle: Rectangle):
+        """
+        Lane colored pixels of the last masked frame inside rectangle (frame coordinates)
+        Fused get_non_zero_pixels: counts the inRange mask directly, without the gray conversion
+        and threshold, so lane pixels darker than 127 in gray are counted as well.
+        Counts of a scaled detector are converted back to frame pixels.
+        """
+        rows, columns = self.window
+        pt1, pt2 = rectangle
+        top = max(int(round(pt1.y * self.scale)) - rows.start, 0)
+        bottom = max(int(round(pt2.y * self.scale)) - rows.start, 0)
+        left = max(int(round(pt1.x * self.scale)) - columns.start, 0)
+        right = max(int(round(pt2.x * self.scale)) - columns.start, 0)
+        count = cv2.countNonZero(self._in_range[top:bottom, left:right])
+        return int(round(count / self.scale ** 2))
+
+    def occupancy(self):
+        """
+        OccupancyMap of the last frame's lane mask, queried in frame coordinates
+        """
+        rows, columns = self.window
+        return OccupancyMap(self._in_range, frame_size=(self.width, self.height),
+                            origin=(columns.start, rows.start), scale=self.scale)
+
+
+@metrics.timed("navigation.filter_lines")
+def filter_line_array(lines, min_slope=None):
+    """
+    Vectorized line filter over the raw cv2.HoughLinesP output
+    params:
+        [1] lines: (N, 1, 4) int array of x1, y1, x2, y2 segments, or None
+        [2] min_slope: drop segments with a smaller absolute slope
+    return:
+        LineArray of the kept segments, their slopes and the mean slope
+    """
     if lines is None:
         return None
-    filtered_lines = []
-    for line in lines:
-        for x1, y1, x2, y2 in line:
-            if abs(x1 - x2) > 25:
-                m = (y2 - y1) / (x2 - x1)
-                if min_slope is None or abs(m) > min_slope:
-                    filtered_lines.append(Line(
-                        pt1=Point(x1, y1),
-                        pt2=Point(x2, y2),
-                        slope=m
-                    ))
-    ret_mean_slope = 0
-    if len(filtered_lines) > 0:
-        mean_slope = statistics.mean([l.slope for l in filtered_lines])
-        for line in filtered_lines:
-            if abs(line.slope - mean_slope) > 0.1:
-                filtered_lines.remove(line)
-        ret_mean_slope = statistics.mean([l.slope for l in filtered_lines])
-
-    return filtered_lines, ret_mean_slope
+    segments = np.asarray(lines).reshape(-1, 4)
+    dx = segments[:, 2] - segments[:, 0]
+    keep = np.abs(dx) > 25
+    segments, dx = segments[keep], dx[keep]
+    slopes = (segments[:, 3] - segments[:, 1]) / dx
+    if min_slope is not None:
+        keep = np.abs(slopes) > min_slope
+        segments, slopes = segments[keep], slopes[keep]
+    mean_slope = 0
+    if len(slopes) > 0:
+        keep = np.abs(slopes - slopes.mean()) <= 0.1
+        segments, slopes = segments[keep], slopes[keep]
+        if len(slopes) > 0:
+            mean_slope = float(slopes.mean())
+    return LineArray(segments=segments, slopes=slopes, mean_slope=mean_slope)
+
+
+def to_lines(line_array: LineArray) -> List[Line]:
+    return [
+        Line(pt1=Point(x1, y1), pt2=Point(x2, y2), slope=m)
+        for (x1, y1, x2, y2), m in zip(line_array.segments.tolist(), line_array.slopes.tolist())
+    ]
+
 
+def filter_lines(lines, min_slope=None):
+    line_array = filter_line_array(lines, min_slope)
+    if line_array is None:
+        return None
+    return to_lines(line_array), line_array.mean_slope
 
+
+@metrics.timed("navigation.non_zero_pixels")
 def get_non_zero_pixels(masked, rectangle: Rectangle):
     pt1, pt2 = rectangle
     masked = masked[pt1.y:pt2.y, pt1.x:pt2.x]
@@ -122,51 +350,158 @@ def get_non_zero_pixels(masked, rectangle: Rectangle):
     return cv2.countNonZero(thresh)
 
 
+class OccupancyMap:
+    """
+    Summed-area table of a binary mask, built once per frame
+    Answers any number of get_non_zero_pixels style rectangle counts in O(1) each,
+    and gives a coarse occupancy grid of the frame.
+    """
+
+    @metrics.timed("navigation.occupancy")
+    def __init__(self, mask, frame_size=None, origin=(0, 0), scale=1.0):
+        """
+        params:
+            [1] mask: single channel array, non-zero pixels are occupied
+            [2] frame_size: (width, height) of the frame the queries refer to, the mask size if None
+            [3] origin: (x, y) of the mask's top left corner in the frame, at the mask's scale
+            [4] scale: mask resolution relative to the frame, counts are converted back to frame pixels
+        """
+        binary = cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY)[1] if mask.dtype == np.uint8 else (mask != 0)
+        self.table = cv2.integral(binary.astype(np.uint8, copy=False), sdepth=cv2.CV_32S)
+        height, width = mask.shape[:2]
+        self.frame_size = frame_size or (width, height)
+        self.origin = origin
+        self.scale = scale
+
+    @classmethod
+    def from_masked(cls, masked):
+        """
+        Occupancy of a masked frame, with get_non_zero_pixels' gray threshold
+        """
+        gray = cv2.cvtColor(masked, cv2.COLOR_RGBA2GRAY) if masked.ndim == 3 else masked
+        return cls(cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)[1])
+
+    @property
+    def total(self):
+        return int(round(int(self.table[-1, -1]) / self.scale ** 2))
+
+    def _to_table(self, x, y):
+        # Frame coordinates -> clipped summed-area table indices, like slicing the mask
+        height, width = self.table.shape[0] - 1, self.table.shape[1] - 1
+        x = np.clip(np.rint(np.asarray(x) * self.scale).astype(np.int64) - self.origin[0], 0, width)
+        y = np.clip(np.rint(np.asarray(y) * self.scale).astype(np.int64) - self.origin[1], 0, height)
+        return x, y
+
+    def counts(self, rectangles):
+        """
+        params:
+            [1] rectangles: Rectangles, or an (N, 4) array of x1, y1, x2, y2
+        return:
+            (N,) array of occupied pixels per rectangle, in frame pixels
+        """
+        rectangles = np.asarray(rectangles, dtype=np.int64).reshape(-1, 4)
+        x1, y1 = self._to_table(rectangles[:, 0], rectangles[:, 1])
+        x2, y2 = self._to_table(rectangles[:, 2], rectangles[:, 3])
+        x2, y2 = np.maximum(x2, x1), np.maximum(y2, y1)
+        table = self.table
+        counts = table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+        if self.scale == 1:
+            return counts
+        return np.rint(counts / self.scale ** 2).astype(np.int64)
+
+    def count(self, rectangle: Rectangle):
+        """
+        Same as get_non_zero_pixels(masked, rectangle), in O(1)
+        """
+        (x1, y1), (x2, y2) = rectangle
+        height, width = self.table.shape[0] - 1, self.table.shape[1] - 1
+        x1 = min(max(int(round(x1 * self.scale)) - self.origin[0], 0), width)
+        x2 = min(max(int(round(x2 * self.scale)) - self.origin[0], x1), width)
+        y1 = min(max(int(round(y1 * self.scale)) - self.origin[1], 0), height)
+        y2 = min(max(int(round(y2 * self.scale)) - self.origin[1], y1), height)
+        table = self.table
+        count = int(table[y2, x2]) - int(table[y1, x2]) - int(table[y2, x1]) + int(table[y1, x1])
+        return count if self.scale == 1 else int(round(count / self.scale ** 2))
+
+    def grid(self, rows, columns):
+        """
+        Coarse occupancy of the frame
+        params:
+            [1] rows, columns: grid size
+        return:
+            (rows, columns) float array, occupied fraction of every cell
+        """
+        width, height = self.frame_size
+        xs, ys = np.linspace(0, width, columns + 1), np.linspace(0, height, rows + 1)
+        x, y = self._to_table(xs, ys)
+        corners = self.table[np.ix_(y, x)]
+        cells = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        areas = np.outer(np.diff(ys), np.diff(xs)) * self.scale ** 2
+        return cells / np.maximum(areas, 1)
+
+
+def _as_segments(filtered_lines):
+    if isinstance(filtered_lines, LineArray):
+        return filtered_lines.segments
+    if isinstance(filtered_lines, np.ndarray):
+        return filtered_lines.reshape(-1, 4)
+    return np.array([(*line.pt1, *line.pt2) for line in filtered_lines], dtype=np.int32).reshape(-1, 4)
+
+
+@metrics.timed("navigation.process_lines")
 def process_lines(image, filtered_lines: List[Line]):
+    """
+    Score forward / right / left turns from the filtered lines
+    params:
+        [1] image: the frame, only its shape is used
+        [2] filtered_lines: a LineArray, an (N, 4) segments array or a list of Lines
+    return:
+        NavScores, or None if no line reaches the bottom of the frame
+    Geometry and score normalization are relative to the frame size,
+    scores of different resolutions are comparable
+    """
     height, width = image.shape[:2]
-    rec_left_y = height - 60
+    x_scale = width / REFERENCE_SIZE[0]
+    y_scale = height / REFERENCE_SIZE[1]
+    distance_scale = math.hypot(width, height) / math.hypot(*REFERENCE_SIZE)
+    rec_left_y = height - int(round(60 * y_scale))
     rec_right_x = int(width / 10)
     rec_right_y = height
-    forward = 0
-    right_count, right_score = 0, 0
-    left_count, left_score = 0, 0
-    right_x_cords = []
-    left_y_cords = []
-
-    max_y_cord = -1
-    for line in filtered_lines:
-        count_before = forward
-        for i in range(2):
-            x, y = line[i]
-            if x < rec_right_x and rec_left_y < y < rec_right_y:
-                forward += 1
-            if y > max_y_cord:
-                max_y_cord = y
-        if count_before == forward:
-            # No forward lines -> right / left
-            for i in range(2):
-                x, y = line[i]
-                if x < rec_right_x and y < rec_left_y:
-                    left_count += 1
-                    left_y_cords.append(y)
-                    break
-                if x > rec_right_x and y > rec_left_y:
-                    right_count += 1
-                    right_x_cords.append(x)
-                    break
-
-    if max_y_cord < 400:
+    right_score, left_score = 0, 0
+
+    segments = _as_segments(filtered_lines)
+    if len(segments) == 0:
+        return None
+    x, y = segments[:, 0::2], segments[:, 1::2]
+    if y.max() < 400 * y_scale:
         return None
 
-    if len(right_x_cords) > 0 and forward < 5:
-        mean_right_point = Point(x=int(statistics.mean(right_x_cords)), y=rec_left_y)
+    forward_points = (x < rec_right_x) & (rec_left_y < y) & (y < rec_right_y)
+    forward = int(forward_points.sum())
+
+    # Lines without forward points -> right / left, decided by their first matching point
+    left_points = (x < rec_right_x) & (y < rec_left_y)
+    right_points = (x > rec_right_x) & (y > rec_left_y)
+    turn_points = left_points | right_points
+    first = np.where(turn_points[:, 0], 0, 1)
+    rows = np.arange(len(segments))
+    turning = ~forward_points.any(axis=1) & turn_points[rows, first]
+    is_left = turning & left_points[rows, first]
+    is_right = turning & right_points[rows, first]
+    left_count = int(is_left.sum())
+    right_count = int(is_right.sum())
+    first_x, first_y = x[rows, first], y[rows, first]
+
+    if right_count > 0 and forward < 5:
+        mean_right_point = Point(x=int(first_x[is_right].mean()), y=rec_left_y)
         line_slope = (mean_right_point.y - height) / (mean_right_point.x - 0)
-        right_score = (0.8 - abs(line_slope)) * distance(mean_right_point, (0, height)) / RIGHT_MAX_VALUE
+        right_score = (0.8 - abs(line_slope)) * distance(mean_right_point, (0, height)) / (
+            RIGHT_MAX_VALUE * distance_scale)
 
-    if len(left_y_cords) > 0 and forward < 5:
-        mean_left_point = Point(x=40, y=int(statistics.mean(left_y_cords)))
+    if left_count > 0 and forward < 5:
+        mean_left_point = Point(x=int(round(40 * x_scale)), y=int(first_y[is_left].mean()))
         line_slope = (mean_left_point.y - height) / (mean_left_point.x - 0)
-        left_score = abs(line_slope) * distance(mean_left_point, (0, height)) / LEFT_MAX_VALUE
+        left_score = abs(line_slope) * distance(mean_left_point, (0, height)) / (LEFT_MAX_VALUE * distance_scale)
 
     return NavScores(
         forward=forward,
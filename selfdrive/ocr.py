@@ -1,24 +1,208 @@
-import keras_ocr
+import collections
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+import cv2
+import numpy as np
+from . import metrics
 
-pipeline: keras_ocr.pipeline.Pipeline
+logger = logging.getLogger(__name__)
+
+OcrResult = namedtuple("OcrResult", ["text", "box"])
+_Request = namedtuple("_Request", ["image", "localized", "future", "time"])
+
+# keras_ocr.pipeline.Pipeline, keras_ocr (and tensorflow) is only imported by load_self
+pipeline = None
+warmup_seconds = None
+
+# Detector and recognizer input sizes, a sign crop and a camera frame
+WARMUP_SHAPES = ((200, 200), (600, 800))
+
+
+def synthetic_text_image(height, width):
+    """
+    White image with black text, so warmup runs both the detector and the recognizer
+    """
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    scale = min(height, width) / 200
+    cv2.putText(image, "LIMIT", (int(20 * scale), int(80 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.5 * scale, (0, 0, 0), max(int(3 * scale), 1), cv2.LINE_AA)
+    cv2.putText(image, "50", (int(60 * scale), int(160 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX, 2.0 * scale, (0, 0, 0), max(int(4 * scale), 1), cv2.LINE_AA)
+    return image
+
+
+def new_pipeline():
+    import keras_ocr
+    return keras_ocr.pipeline.Pipeline()
+
+
+def warmup(ocr_pipeline):
+    """
+    Run the detector and the recognizer once at every WARMUP_SHAPES size
+    return:
+        seconds it took
+    """
+    start = time.perf_counter()
+    ocr_pipeline.recognize([synthetic_text_image(*shape) for shape in WARMUP_SHAPES])
+    seconds = time.perf_counter() - start
+    logger.info("OCR warmup took %.2fs", seconds)
+    return seconds
 
 
 def load_self():
-    global pipeline
-    pipeline = keras_ocr.pipeline.Pipeline()
-    warmup_images = [
-        'https://storage.googleapis.com/gcptutorials.com/examples/keras-ocr-img-1.jpg',
-        'https://storage.googleapis.com/gcptutorials.com/examples/keras-ocr-img-2.png',
-    ]
-    predict(warmup_images)
+    global pipeline, warmup_seconds
+    pipeline = new_pipeline()
+    warmup_seconds = warmup(pipeline)
 
 
 def predict(input_images):
-    images = [
-        keras_ocr.tools.read(url) for url in input_images
-    ]
-    prediction_groups = pipeline.recognize(images)
+    import keras_ocr
+    with metrics.stage("ocr.read"):
+        images = [
+            keras_ocr.tools.read(url) for url in input_images
+        ]
+    with metrics.stage("ocr.recognize"):
+        prediction_groups = pipeline.recognize(images)
     for i in range(len(prediction_groups)):
         predicted_image = prediction_groups[i]
         for text, box in predicted_image:
-            return text
\ No newline at end of file
+            return text
+
+
+def _full_box(image):
+    height, width = image.shape[:2]
+    return np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32)
+
+
+class OcrEngine:
+    """
+    Shares one keras_ocr pipeline between threads
+    Requests of every thread are micro-batched: a batch is sent once max_batch images
+    are queued, or max_delay seconds after its first image, whichever comes first.
+    Localized requests (crops that are already a single text box, e.g. a speed-limit sign)
+    skip the CRAFT detector and only run the recognizer.
+    """
+
+    def __init__(self, ocr_pipeline=None, max_batch=8, max_delay=.01, bgr=True, warm=True, cache=None):
+        """
+        params:
+            [1] ocr_pipeline: keras_ocr.pipeline.Pipeline to share, a new one if None
+            [2] max_batch: images per pipeline call
+            [3] max_delay: seconds the first image of a batch waits for more
+            [4] bgr: images are BGR (cv2) arrays, keras_ocr expects RGB
+            [5] warm: run the warmup images before serving
+            [6] cache: optional cache.PerceptualCache, images close to an earlier one get its results
+        """
+        if max_batch < 1:
+            raise ValueError("Value must be at least 1")
+        self.pipeline = ocr_pipeline or new_pipeline()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.bgr = bgr
+        self.cache = cache
+        self.warmup_seconds = warmup(self.pipeline) if warm else None
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="OcrEngine", daemon=True)
+        self._thread.start()
+
+    def submit(self, image, localized=False):
+        """
+        Queue an image
+        params:
+            [1] image: frame or crop array
+            [2] localized: image is a single text box, run the recognizer only
+        return:
+            Future of the image's list of OcrResult, boxes as 4 (x, y) corners
+        """
+        if self.bgr and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        future = Future()
+        if self.cache is not None:
+            fingerprint = self.cache.fingerprint(image)
+            tag = ("ocr", localized)
+            cached = self.cache.get(fingerprint, tag)
+            if cached is not None:
+                future.set_result(cached)
+                return future
+            future.add_done_callback(
+                lambda done: done.cancelled() or done.exception() or self.cache.put(fingerprint, done.result(), tag)
+            )
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("OcrEngine is closed")
+            self._queue.append(_Request(image=image, localized=localized, future=future, time=time.monotonic()))
+            self._condition.notify_all()
+        return future
+
+    def recognize(self, images, localized=False, timeout=None):
+        """
+        Blocking submit of many images
+        return:
+            list of OcrResult lists, in the order of images
+        """
+        futures = [self.submit(image, localized) for image in images]
+        return [future.result(timeout) for future in futures]
+
+    def _next_batch(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._queue or self._closed)
+            if not self._queue:
+                return None
+            deadline = self._queue[0].time + self.max_delay
+            while len(self._queue) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            for localized in (False, True):
+                requests = [request for request in batch if request.localized == localized]
+                if not requests:
+                    continue
+                try:
+                    results = self._recognize([request.image for request in requests], localized)
+                except Exception as e:
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                for request, result in zip(requests, results):
+                    request.future.set_result(result)
+
+    def _recognize(self, images, localized):
+        if not localized:
+            with metrics.stage("ocr.recognize"):
+                prediction_groups = self.pipeline.recognize(images)
+            return [[OcrResult(text=text, box=box) for text, box in group] for group in prediction_groups]
+        boxes = [_full_box(image) for image in images]
+        with metrics.stage("ocr.recognize_crops"):
+            text_groups = self.pipeline.recognizer.recognize_from_boxes(
+                images=images, box_groups=[[box] for box in boxes], batch_size=self.max_batch
+            )
+        return [[OcrResult(text=text, box=box) for text in texts] for texts, box in zip(text_groups, boxes)]
+
+    def close(self, timeout=None):
+        """
+        Stop accepting images, queued ones are still recognized
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,204 @@
+import collections
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from . import navigation
+
+NavResult = namedtuple("NavResult", ["camera", "frame_id", "scores", "mean_slope", "segments"])
+_Pending = namedtuple("_Pending", ["slot", "camera", "frame_id", "future"])
+
+# Worker process state, set by _init_worker
+_worker = {}
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13, workers share the parent's resource tracker,
+        # the block is registered once and unlinked by close()
+        return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(name, shape, dtype, region, min_slope, scale):
+    shm = _attach(name)
+    _worker["shm"] = shm
+    _worker["frames"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    height, width = shape[1:3]
+    _worker["detector"] = navigation.LaneDetector(width, height, navigation.REGIONS[region](width, height), scale=scale)
+    _worker["min_slope"] = min_slope
+
+
+def _process_slot(slot, camera, frame_id):
+    frame = _worker["frames"][slot]
+    lines, _ = _worker["detector"].detect(frame)
+    filtered = navigation.filter_line_array(lines, _worker["min_slope"])
+    if filtered is None:
+        return NavResult(camera=camera, frame_id=frame_id, scores=None, mean_slope=None, segments=None)
+    return NavResult(
+        camera=camera,
+        frame_id=frame_id,
+        scores=navigation.process_lines(frame, filtered),
+        mean_slope=filtered.mean_slope,
+        segments=filtered.segments
+    )
+
+
+class NavigationPipeline:
+    """
+    Runs detect_lanes -> filter_lines -> process_lines for many cameras on a process pool
+    Frames are copied once into shared memory slots instead of being pickled. Results
+    come back in submission order per camera. Only one frame per worker is handed to the
+    process pool at a time, the others wait in the pipeline's own queue. When every slot
+    is busy, submit() either waits (backpressure) or, with drop_oldest, drops the oldest
+    queued frame, so a frame waits for at most slots - workers newer ones.
+    """
+
+    def __init__(self, width, height, channels=3, workers=None, slots=None, region="turn", min_slope=None,
+                 drop_oldest=False, scale=1.0):
+        """
+        params:
+            [1] width, height, channels: frame shape, the same for every camera
+            [2] workers: processes, os.cpu_count() if None
+            [3] slots: frames in flight, twice the workers if None
+            [4] region: "turn" or "steer" detection region
+            [5] min_slope: filter_lines min_slope
+            [6] drop_oldest: drop the oldest queued frame instead of blocking submit(),
+                submit() still waits when every slot is being processed (slots <= workers)
+            [7] scale: LaneDetector scale, detect on downscaled frames
+        """
+        workers = workers or os.cpu_count() or 1
+        slots = slots or 2 * workers
+        shape = (slots, height, width, channels)
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self._frames = np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf)
+        # Touch every page now, the first submits don't pay for the page faults
+        self._frames.fill(0)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(self._shm.name, shape, np.uint8, region, min_slope, scale)
+        )
+        self.workers = workers
+        self.drop_oldest = drop_oldest
+        self._condition = threading.Condition(threading.RLock())
+        self._free = collections.deque(range(slots))
+        # Frames not handed to the pool yet, oldest first, and the count being processed
+        self._pending = collections.deque()
+        self._running = 0
+        self._queues = collections.defaultdict(collections.deque)
+        self._next_frame_id = 0
+        self.dropped = 0
+
+    @property
+    def frame_shape(self):
+        return self._frames.shape[1:]
+
+    def _dispatch(self):
+        """
+        Hand queued frames to the pool while a worker is idle
+        """
+        with self._condition:
+            while self._pending and self._running < self.workers:
+                pending = self._pending.popleft()
+                if not pending.future.set_running_or_notify_cancel():
+                    # Cancelled by the caller while queued
+                    self._free.append(pending.slot)
+                    self._condition.notify_all()
+                    continue
+                self._running += 1
+                task = self._executor.submit(_process_slot, pending.slot, pending.camera, pending.frame_id)
+                task.add_done_callback(lambda done, pending=pending: self._finished(pending, done))
+
+    def _finished(self, pending: _Pending, task):
+        with self._condition:
+            self._running -= 1
+            self._free.append(pending.slot)
+            self._condition.notify_all()
+        if task.cancelled():
+            pending.future.cancel()
+        elif task.exception() is not None:
+            pending.future.set_exception(task.exception())
+        else:
+            pending.future.set_result(task.result())
+        self._dispatch()
+
+    def _drop_oldest(self):
+        """
+        Drop the oldest queued frame, False if every slot is being processed
+        """
+        while self._pending:
+            pending = self._pending.popleft()
+            self._free.append(pending.slot)
+            if pending.future.cancel():
+                self.dropped += 1
+                return True
+        return False
+
+    def _acquire_slot(self, timeout):
+        with self._condition:
+            while not self._free:
+                if self.drop_oldest and self._drop_oldest():
+                    break
+                if not self._condition.wait(timeout):
+                    raise TimeoutError("No free frame slot")
+            return self._free.popleft()
+
+    def submit(self, camera, frame, timeout=None):
+        """
+        Queue a frame of a camera
+        params:
+            [1] camera: any hashable camera id
+            [2] frame: array of frame_shape
+            [3] timeout: seconds to wait for a free slot
+        return:
+            Future of the NavResult, cancelled if the frame gets dropped
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"Expected a {self.frame_shape} frame, got {frame.shape}")
+        slot = self._acquire_slot(timeout)
+        np.copyto(self._frames[slot], frame)
+        future = Future()
+        with self._condition:
+            frame_id = self._next_frame_id
+            self._next_frame_id += 1
+            self._pending.append(_Pending(slot=slot, camera=camera, frame_id=frame_id, future=future))
+            self._queues[camera].append(future)
+        self._dispatch()
+        return future
+
+    def results(self, camera=None):
+        """
+        Finished results, in submission order per camera, stopping at a camera's first unfinished frame
+        params:
+            [1] camera: only this camera's results, every camera if None
+        """
+        with self._condition:
+            cameras = [camera] if camera is not None else list(self._queues)
+            ready = []
+            for name in cameras:
+                queue = self._queues[name]
+                while queue and queue[0].done():
+                    future = queue.popleft()
+                    if not future.cancelled():
+                        ready.append(future)
+        return [future.result() for future in ready]
+
+    def close(self):
+        with self._condition:
+            pending, self._pending = self._pending, collections.deque()
+        for queued in pending:
+            queued.future.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._frames = None
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,337 @@
+"""
+asyncio runtime for the perception and control loop
+
+    runtime = Runtime(frames, controls, navigate=tracker.update, detect_signs=scanner.scan,
+                      read_speed_limit=OcrSpeedLimitReader(ocr_engine))
+    asyncio.run(runtime.run())   # or runtime.run_sync()
+
+Frames are pulled from the source without blocking the loop. Navigation and sign
+detection (with the OCR of the sign digits) run concurrently on their own executors,
+always on the newest frame, so a slow model call never queues lane detection behind it.
+A control loop merges the latest results into PhysicsControl on a fixed tick. A sign
+reading that misses its deadline is counted as late and applied on the next tick,
+the steering never waits for it.
+"""
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from .navigation import NavScores
+from .vehicle_control import PhysicsControl
+
+ControlCommand = namedtuple("ControlCommand", ["tick", "time", "frame_id", "values", "scores", "speed_limit"])
+RuntimeStats = namedtuple("RuntimeStats", ["frames", "navigated", "signs", "late_signs", "skipped_frames", "ticks",
+                                           "overruns"])
+_Result = namedtuple("_Result", ["frame_id", "value", "time"])
+
+_END = object()
+
+
+def scores_of(result):
+    """
+    NavScores of a navigate() result: NavScores, or anything with a scores field (TrackResult, NavResult)
+    """
+    if result is None or isinstance(result, NavScores):
+        return result
+    return getattr(result, "scores", None)
+
+
+def parse_speed_limit(text):
+    """
+    Speed written in a label or an OCR reading, None if it holds no digits
+    """
+    digits = "".join(char for char in str(text) if char.isdigit())
+    return int(digits) if digits and int(digits) > 0 else None
+
+
+def speed_limit_of(signs):
+    """
+    Speed of the best scored sign with a numeric label, None if there is none
+    Only for models with a class per speed, the speedlimit model has a single class,
+    its signs are read with an OcrSpeedLimitReader
+    """
+    for sign in sorted(signs or (), key=lambda detection: detection.score, reverse=True):
+        speed = parse_speed_limit(sign.label)
+        if speed is not None:
+            return speed
+    return None
+
+
+class OcrSpeedLimitReader:
+    """
+    Reads the digits of detected signs with an ocr.OcrEngine, a read_speed_limit callable
+    Every sign box is cropped from the frame and recognized in one batch, recognizer only
+    """
+
+    def __init__(self, engine, timeout=None):
+        """
+        params:
+            [1] engine: ocr.OcrEngine, its bgr setting must match the frames
+            [2] timeout: seconds to wait for the readings
+        """
+        self.engine = engine
+        self.timeout = timeout
+
+    def __call__(self, frame, signs):
+        """
+        params:
+            [1] frame: the frame the signs were detected in
+            [2] signs: SignDetection list, boxes as frame pixels (ymin, xmin, ymax, xmax)
+        return:
+            speed of the best scored readable sign, None if no sign is readable
+        """
+        height, width = frame.shape[:2]
+        crops = []
+        for sign in sorted(signs or (), key=lambda detection: detection.score, reverse=True):
+            ymin, xmin, ymax, xmax = sign.box
+            crop = frame[max(int(ymin), 0):min(int(ymax), height), max(int(xmin), 0):min(int(xmax), width)]
+            if crop.size:
+                crops.append(crop)
+        if not crops:
+            return None
+        for results in self.engine.recognize(crops, localized=True, timeout=self.timeout):
+            speed = parse_speed_limit("".join(result.text for result in results))
+            if speed is not None:
+                return speed
+        return None
+
+
+def default_policy(controls: PhysicsControl, scores: NavScores, speed_limit):
+    """
+    Steer towards the stronger turn score, keep straight when the lane is ahead,
+    and brake down to a new speed limit
+    params:
+        [1] controls: the PhysicsControl being driven
+        [2] scores: newest NavScores, None when no new frame was navigated
+        [3] speed_limit: newest speed limit, None when no new sign was read
+    """
+    if scores is not None:
+        if scores.right_score > 0 and scores.right_score >= scores.left_score:
+            controls.right(min(scores.right_score, 1.0))
+        elif scores.left_score > 0:
+            controls.left(min(scores.left_score, 1.0))
+        elif scores.forward:
+            controls.steer = 0
+    if speed_limit is not None:
+        controls.set_brake_target(speed_limit)
+
+
+class Runtime:
+    """
+    Pulls frames, fans them out to navigation and sign detection, and drives a PhysicsControl
+    """
+
+    def __init__(self, source, controls: PhysicsControl, navigate, detect_signs=None, read_speed_limit=None,
+                 policy=default_policy, tick=.05, sign_deadline=None, navigation_workers=1, on_command=None,
+                 realtime=True):
+        """
+        params:
+            [1] source: iterable or async iterable of frames, iterables are read on a thread
+            [2] controls: PhysicsControl driven by the tick, a stepped one is stepped by tick seconds
+            [3] navigate: blocking frame -> NavScores (or TrackResult / NavResult) callable,
+                e.g. LaneTracker.update
+            [4] detect_signs: optional blocking frame -> SignDetection list callable,
+                e.g. SpeedLimitScanner.scan
+            [5] read_speed_limit: optional blocking (frame, signs) -> speed or None callable run after
+                detect_signs, e.g. an OcrSpeedLimitReader. speed_limit_of the labels if None
+            [6] policy: (controls, scores, speed_limit) callable run on every tick with new results
+            [7] tick: seconds between control updates
+            [8] sign_deadline: seconds a sign reading may take before it's counted as late,
+                4 ticks if None. Late readings are still applied, on the tick after they arrive
+            [9] navigation_workers: frames navigated at once, > 1 only if navigate is thread safe
+                (e.g. a stateless LaneDetector pipeline, not a LaneTracker)
+            [10] on_command: optional ControlCommand callback, called on every tick
+            [11] realtime: the newest frame wins and frames navigation can't keep up with are
+                 skipped (cameras). False navigates every frame, the source waits (replays)
+        """
+        if navigation_workers < 1:
+            raise ValueError("Value must be at least 1")
+        if tick <= 0:
+            raise ValueError("Tick must be positive")
+        self.source = source
+        self.controls = controls
+        self.navigate = navigate
+        self.detect_signs = detect_signs
+        self.read_speed_limit = read_speed_limit
+        self.policy = policy
+        self.tick = tick
+        self.sign_deadline = 4 * tick if sign_deadline is None else sign_deadline
+        self.navigation_workers = navigation_workers
+        self.on_command = on_command
+        self.realtime = realtime
+        self._frames = 0
+        self._navigated = 0
+        self._signs = 0
+        self._late_signs = 0
+        self._skipped = 0
+        self._ticks = 0
+        self._overruns = 0
+        self._latest_frame = None
+        self._frame_event = None
+        self._frame_taken = None
+        self._source_done = False
+        self._claimed = -1
+        self._navigation = None
+        self._signs_result = None
+
+    def stats(self):
+        return RuntimeStats(
+            frames=self._frames,
+            navigated=self._navigated,
+            signs=self._signs,
+            late_signs=self._late_signs,
+            skipped_frames=self._skipped,
+            ticks=self._ticks,
+            overruns=self._overruns
+        )
+
+    async def _pull_frames(self, loop, executor):
+        if hasattr(self.source, "__aiter__"):
+            async for frame in self.source:
+                await self._push_frame(frame)
+        else:
+            iterator = iter(self.source)
+            while True:
+                frame = await loop.run_in_executor(executor, next, iterator, _END)
+                if frame is _END:
+                    break
+                await self._push_frame(frame)
+        self._source_done = True
+        self._frame_event.set()
+
+    async def _push_frame(self, frame):
+        if not self.realtime:
+            await self._frame_taken.wait()
+            self._frame_taken.clear()
+        self._latest_frame = (self._frames, frame)
+        self._frames += 1
+        self._frame_event.set()
+
+    async def _next_frame(self, last_id):
+        """
+        Newest frame after last_id, None once the source is done
+        Frames that arrived in between are skipped, workers never fall behind the camera
+        """
+        while self._latest_frame is None or self._latest_frame[0] <= last_id:
+            if self._source_done:
+                return None
+            self._frame_event.clear()
+            await self._frame_event.wait()
+        frame_id, frame = self._latest_frame
+        return frame_id, frame
+
+    async def _navigation_worker(self, loop, executor):
+        """
+        One of navigation_workers tasks, each claims the newest frame no other worker took
+        """
+        while True:
+            latest = await self._next_frame(self._claimed)
+            if latest is None:
+                return
+            frame_id, frame = latest
+            if frame_id <= self._claimed:
+                # Another worker woke up first and took it
+                continue
+            self._skipped += frame_id - self._claimed - 1
+            self._claimed = frame_id
+            self._frame_taken.set()
+            result = await loop.run_in_executor(executor, self.navigate, frame)
+            self._navigated += 1
+            # Workers finish out of order, an older frame never replaces a newer result
+            if self._navigation is None or frame_id > self._navigation.frame_id:
+                self._navigation = _Result(frame_id=frame_id, value=result, time=loop.time())
+
+    def _read_signs(self, frame):
+        signs = self.detect_signs(frame)
+        if self.read_speed_limit is not None:
+            return signs, (self.read_speed_limit(frame, signs) if signs else None)
+        return signs, speed_limit_of(signs)
+
+    async def _sign_worker(self, loop, executor):
+        last_id = -1
+        while True:
+            latest = await self._next_frame(last_id)
+            if latest is None:
+                return
+            frame_id, frame = latest
+            last_id = frame_id
+            start = loop.time()
+            signs, speed_limit = await loop.run_in_executor(executor, self._read_signs, frame)
+            if loop.time() - start > self.sign_deadline:
+                # Steering kept its own tick meanwhile, the reading is still applied on the next one
+                self._late_signs += 1
+            self._signs += 1
+            self._signs_result = _Result(frame_id=frame_id, value=speed_limit, time=loop.time())
+
+    def _apply(self, loop, tick, applied):
+        navigation, signs = self._navigation, self._signs_result
+        scores, speed_limit = None, None
+        if navigation is not None and navigation.frame_id != applied[0]:
+            scores = scores_of(navigation.value)
+            applied[0] = navigation.frame_id
+        if signs is not None and signs.frame_id != applied[1]:
+            speed_limit = signs.value
+            applied[1] = signs.frame_id
+        if scores is not None or speed_limit is not None:
+            self.policy(self.controls, scores, speed_limit)
+        if self.controls.stepped:
+            self.controls.step(self.tick)
+        if self.on_command:
+            self.on_command(ControlCommand(
+                tick=tick,
+                time=loop.time(),
+                frame_id=navigation.frame_id if navigation else None,
+                values=self.controls.get_values(),
+                scores=scores,
+                speed_limit=speed_limit
+            ))
+
+    async def _control_loop(self, loop, workers):
+        start = loop.time()
+        applied = [None, None]
+        tick = 0
+        while not all(worker.done() for worker in workers):
+            tick += 1
+            # Ticks are scheduled from the start time, so they don't drift
+            delay = start + tick * self.tick - loop.time()
+            if delay < 0:
+                self._overruns += 1
+            await asyncio.sleep(max(delay, 0))
+            self._ticks += 1
+            self._apply(loop, tick, applied)
+        # Results of the last frames
+        self._apply(loop, tick + 1, applied)
+
+    async def run(self):
+        """
+        Run until the source is exhausted and every frame in flight is processed
+        return:
+            RuntimeStats
+        """
+        loop = asyncio.get_running_loop()
+        self._frame_event = asyncio.Event()
+        self._frame_taken = asyncio.Event()
+        self._frame_taken.set()
+        self._source_done = False
+        self._claimed = -1
+        with ThreadPoolExecutor(1, thread_name_prefix="RuntimeSource") as source_executor, \
+                ThreadPoolExecutor(self.navigation_workers, thread_name_prefix="RuntimeNavigation") as nav_executor, \
+                ThreadPoolExecutor(1, thread_name_prefix="RuntimeSigns") as sign_executor:
+            workers = [asyncio.ensure_future(self._pull_frames(loop, source_executor))]
+            workers.extend(
+                asyncio.ensure_future(self._navigation_worker(loop, nav_executor))
+                for _ in range(self.navigation_workers)
+            )
+            if self.detect_signs is not None:
+                workers.append(asyncio.ensure_future(self._sign_worker(loop, sign_executor)))
+            control = asyncio.ensure_future(self._control_loop(loop, workers))
+            try:
+                # The first failure, a worker's or the control tick's, stops the run,
+                # controls never stay frozen while frames keep coming
+                await asyncio.gather(*workers, control)
+            finally:
+                for task in workers + [control]:
+                    task.cancel()
+        return self.stats()
+
+    def run_sync(self):
+        return asyncio.run(self.run())
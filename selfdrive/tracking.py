@@ -0,0 +1,218 @@
+"""
+Temporal lane tracking on top of navigation.LaneDetector
+
+Consecutive frames barely move, so after a full detection the lane is followed by
+searching a narrow band around its predicted position. Only small windows along the
+band are masked and run through Canny, and Hough only sees the edges inside the band.
+A full detection runs again when the tracked confidence drops, or every max_tracked frames.
+"""
+from collections import namedtuple
+import cv2
+import numpy as np
+from . import metrics
+from . import navigation
+from .navigation import Masks, NavScores, Range, CANNY_MARGIN
+
+TrackResult = namedtuple("TrackResult", ["scores", "mean_slope", "lines", "tracked", "confidence"])
+
+# Length in pixels of the band pieces processed as separate windows
+BAND_PIECE = 64
+
+
+def fit_lane(segments):
+    """
+    Least-squares line through the segment endpoints
+    params:
+        [1] segments: (N, 4) x1, y1, x2, y2 array, N > 0
+    return:
+        ((x1, y1, x2, y2) extent of the segments along the line, RMS distance of the endpoints from it)
+    """
+    points = segments.reshape(-1, 2).astype(np.float32)
+    vx, vy, x0, y0 = cv2.fitLine(points, cv2.DIST_L2, 0, 0.01, 0.01).ravel()
+    # Orient the direction downwards (or rightwards) so endpoints keep their order between frames
+    if vy < 0 or (vy == 0 and vx < 0):
+        vx, vy = -vx, -vy
+    offsets = points - (x0, y0)
+    along = offsets @ (vx, vy)
+    across = offsets @ (-vy, vx)
+    extent = np.array([x0 + vx * along.min(), y0 + vy * along.min(), x0 + vx * along.max(), y0 + vy * along.max()])
+    return extent, float(np.sqrt(np.mean(across ** 2)))
+
+
+def _total_length(segments):
+    return float(np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1]).sum())
+
+
+class LaneTracker:
+    """
+    Detects lanes like LaneDetector -> filter_line_array -> process_lines, frame after frame
+    The lane is tracked as a single line, its endpoints predicted with double exponential
+    smoothing (level and trend). Scores and the mean slope are smoothed as well, so the
+    steering input jitters less between frames.
+    """
+
+    def __init__(self, width, height, vertices, mask: Range = Masks.yellow, min_slope=None, band=24, alpha=.6,
+                 beta=.3, min_confidence=.5, max_tracked=30, margin=CANNY_MARGIN, scale=1.0):
+        """
+        params:
+            [1] width, height: frame size
+            [2] vertices: ROI polygon, as passed to detect_lanes
+            [3] mask: HSV range of the lanes
+            [4] min_slope: filter_lines min_slope
+            [5] band: half width in pixels of the band searched around the predicted lane
+            [6] alpha, beta: smoothing of the lane position and of its motion, 1 disables smoothing
+            [7] min_confidence: tracked frames below it fall back to a full detection
+            [8] max_tracked: tracked frames in a row before a full detection, catches new lanes
+            [9] margin: padding of the band windows for Canny
+            [10] scale: LaneDetector scale of the full detections
+        """
+        if not 0 < alpha <= 1 or not 0 <= beta <= 1:
+            raise ValueError("Smoothing factors must be in (0, 1]")
+        self.detector = navigation.LaneDetector(width, height, vertices, mask, scale=scale)
+        self.width = width
+        self.height = height
+        self.min_slope = min_slope
+        self.band = band
+        self.alpha = alpha
+        self.beta = beta
+        self.min_confidence = min_confidence
+        self.max_tracked = max_tracked
+        self.margin = margin
+        self._lower = np.array(mask.lower, dtype="uint8")
+        self._upper = np.array(mask.upper, dtype="uint8")
+        self._roi = navigation.region_geometry(width, height, vertices).mask
+        self._band_mask = np.zeros((height, width), dtype="uint8")
+        self._edges = np.zeros((height, width), dtype="uint8")
+        self.full_detections = 0
+        self.tracked_frames = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the tracked lane, the next frame gets a full detection
+        """
+        self._level = None
+        self._trend = None
+        self._reference_length = 0.0
+        self._tracked_in_row = 0
+        self._mean_slope = None
+        self._scores = None
+
+    @property
+    def tracking(self):
+        return self._level is not None
+
+    def _predicted(self):
+        """
+        Predicted lane extent, lengthened by the band at both ends so a growing lane is still found
+        """
+        x1, y1, x2, y2 = self._level + self._trend
+        length = max(np.hypot(x2 - x1, y2 - y1), 1.0)
+        dx, dy = (x2 - x1) / length * self.band, (y2 - y1) / length * self.band
+        return np.array([x1 - dx, y1 - dy, x2 + dx, y2 + dy])
+
+    def _band_windows(self, extent):
+        x1, y1, x2, y2 = extent
+        pieces = max(int(np.hypot(x2 - x1, y2 - y1) // BAND_PIECE), 1)
+        xs, ys = np.linspace(x1, x2, pieces + 1), np.linspace(y1, y2, pieces + 1)
+        pad = self.band + self.margin
+        windows = []
+        for i in range(pieces):
+            top = max(int(min(ys[i], ys[i + 1]) - pad), 0)
+            bottom = min(int(max(ys[i], ys[i + 1]) + pad) + 1, self.height)
+            left = max(int(min(xs[i], xs[i + 1]) - pad), 0)
+            right = min(int(max(xs[i], xs[i + 1]) + pad) + 1, self.width)
+            if top < bottom and left < right:
+                windows.append((top, bottom, left, right))
+        return windows
+
+    def _detect_in_band(self, img):
+        extent = self._predicted()
+        self._band_mask.fill(0)
+        self._edges.fill(0)
+        pt1 = (int(round(extent[0])), int(round(extent[1])))
+        pt2 = (int(round(extent[2])), int(round(extent[3])))
+        cv2.line(self._band_mask, pt1, pt2, 255, 2 * self.band + 1)
+        cv2.bitwise_and(self._band_mask, self._roi, dst=self._band_mask)
+        for top, bottom, left, right in self._band_windows(extent):
+            src = img[top:bottom, left:right]
+            hsv = cv2.cvtColor(src, cv2.COLOR_BGR2HSV)
+            masked = cv2.bitwise_and(src, src, mask=cv2.inRange(hsv, self._lower, self._upper))
+            edges = cv2.Canny(masked, 100, 200)
+            # Windows overlap, keep every edge found
+            np.maximum(self._edges[top:bottom, left:right], edges, out=self._edges[top:bottom, left:right])
+        cv2.bitwise_and(self._edges, self._band_mask, dst=self._edges)
+        return navigation.hough_lines(self._edges)
+
+    def _update_lane(self, extent, full):
+        if full or self._level is None:
+            if self._level is None:
+                self._trend = np.zeros(4)
+            else:
+                self._trend = self.beta * (extent - self._level) + (1 - self.beta) * self._trend
+            self._level = extent
+            return
+        level = self.alpha * extent + (1 - self.alpha) * (self._level + self._trend)
+        self._trend = self.beta * (level - self._level) + (1 - self.beta) * self._trend
+        self._level = level
+
+    def _smooth(self, scores: NavScores, mean_slope):
+        if self._mean_slope is None:
+            self._mean_slope = mean_slope
+        else:
+            self._mean_slope = self.alpha * mean_slope + (1 - self.alpha) * self._mean_slope
+        if scores is None:
+            self._scores = None
+            return None
+        if self._scores is not None:
+            scores = scores._replace(
+                right_score=self.alpha * scores.right_score + (1 - self.alpha) * self._scores.right_score,
+                left_score=self.alpha * scores.left_score + (1 - self.alpha) * self._scores.left_score
+            )
+        self._scores = scores
+        return scores
+
+    def update(self, img):
+        """
+        Process the next frame
+        params:
+            [1] img: BGR frame of the tracker's size
+        return:
+            TrackResult, scores as returned by process_lines (right / left scores smoothed),
+            None when no lane is found
+        """
+        line_array, extent, confidence = None, None, 0.0
+        if self.tracking and self._tracked_in_row < self.max_tracked:
+            with metrics.stage("tracking.band"):
+                line_array = navigation.filter_line_array(self._detect_in_band(img), self.min_slope)
+            if line_array is not None and len(line_array.segments):
+                extent, residual = fit_lane(line_array.segments)
+                confidence = min(_total_length(line_array.segments) / self._reference_length, 1.0)
+                if residual > self.band / 2:
+                    confidence = 0.0
+        tracked = extent is not None and confidence >= self.min_confidence
+
+        if tracked:
+            self._tracked_in_row += 1
+            self.tracked_frames += 1
+            self._update_lane(extent, full=False)
+        else:
+            self.full_detections += 1
+            self._tracked_in_row = 0
+            lines, _ = self.detector.detect(img)
+            line_array = navigation.filter_line_array(lines, self.min_slope)
+            if line_array is None or not len(line_array.segments):
+                self.reset()
+                return TrackResult(scores=None, mean_slope=None, lines=line_array, tracked=False, confidence=0.0)
+            extent, residual = fit_lane(line_array.segments)
+            confidence = 1.0
+            if residual > self.band / 2:
+                # Several lanes, a single band can't follow them
+                self._level = None
+            else:
+                self._update_lane(extent, full=True)
+                self._reference_length = _total_length(line_array.segments)
+
+        scores = self._smooth(navigation.process_lines(img, line_array), line_array.mean_slope)
+        return TrackResult(scores=scores, mean_slope=self._mean_slope, lines=line_array, tracked=tracked,
+                           confidence=confidence)
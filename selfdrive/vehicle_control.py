@@ -1,21 +1,138 @@
 import threading
 import time
+import numpy as np
 from collections import namedtuple
 
 Values = namedtuple("Values", ["steer", "throttle", "brake"])
 
+# Seconds between two steps of a ramp
+STEER_INTERVAL = 0.2
+THROTTLE_INTERVAL = 0.25
+BRAKE_INTERVAL = 0.2
+
+
+class ControlScheduler:
+    """
+    Drives the steer, throttle and brake ramps of many PhysicsControl instances from one thread
+    A controller is only visited while one of its ramps is active, and the thread
+    sleeps when no ramp is.
+    """
+
+    def __init__(self, rate=20):
+        """
+        params:
+            [1] rate: ticks per second while ramps are active
+        """
+        self.interval = 1 / rate
+        self._active = set()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def active_count(self):
+        with self._condition:
+            return len(self._active)
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="ControlScheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+            thread, self._thread = self._thread, None
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def wake(self, controller):
+        """
+        Called by a controller (holding its lock) after one of its targets changed
+        """
+        with self._condition:
+            if controller not in self._active:
+                self._active.add(controller)
+                self._condition.notify_all()
+
+    def remove(self, controller):
+        with self._condition:
+            self._active.discard(controller)
+
+    def _run(self):
+        last = time.monotonic()
+        while True:
+            with self._condition:
+                if self._running and not self._active:
+                    self._condition.wait_for(lambda: self._active or not self._running)
+                    last = time.monotonic()
+                if not self._running:
+                    return
+                controllers = list(self._active)
+            now = time.monotonic()
+            dt, last = now - last, now
+            for controller in controllers:
+                with controller._lock:
+                    if not controller._advance(dt):
+                        self.remove(controller)
+            with self._condition:
+                self._condition.wait(max(self.interval - (time.monotonic() - now), 0))
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    Process wide scheduler, shared by every PhysicsControl created without one
+    """
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = ControlScheduler()
+        _default_scheduler.start()
+        return _default_scheduler
+
+
+def synchronized(func):
+    """
+    Run a PhysicsControl mutator under its lock, and hand active ramps to the scheduler
+    """
+    def inner(self, *args, **kwargs):
+        with self._lock:
+            ret = func(self, *args, **kwargs)
+            if self._scheduler and self._ramps_active():
+                self._scheduler.wake(self)
+            return ret
+
+    return inner
+
 
 class PhysicsControl:
     """
     Constructor
     """
 
-    def __init__(self):
+    def __init__(self, scheduler: ControlScheduler = None, stepped=False):
+        """
+        params:
+            [1] scheduler: drives the ramps, default_scheduler() if None
+            [2] stepped: no scheduler and no wall clock, time only moves with step(dt)
+        """
         # Wheel settings
         self._steer = 0  # between -1.0 1.0
         self._throttle = 0  # between 0 1.0
         self._brake_val = 0  # between 0 1.0
-        self._maintain_time_stamp = 0
+        self._maintain_time_stamp = float("-inf")
         self._next_interval = 1
         self._forward_speed = 0  # M / s
         self._current_speed = 0  # KM / h
@@ -31,16 +148,21 @@ class PhysicsControl:
         self._steer_target = 0
         self._brake_target = 0
 
-        # Threads
-        threading.Thread(target=self._control_throttle_value).start()
-        threading.Thread(target=self._control_steer_value).start()
-        threading.Thread(target=self._brake_to_target_value).start()
+        # Ramps, seconds since their last step
+        self._steer_elapsed = 0
+        self._throttle_elapsed = 0
+        self._brake_elapsed = 0
+
+        self._lock = threading.RLock()
+        self._time = 0 if stepped else None
+        self._scheduler = None if stepped else scheduler or default_scheduler()
 
     @property
     def steer(self):
         return self._steer
 
     @steer.setter
+    @synchronized
     def steer(self, value):
         if self.steer_back_slowly:
             if value > 0:
@@ -55,6 +177,7 @@ class PhysicsControl:
         return self._brake_target
 
     @brake_target.setter
+    @synchronized
     def brake_target(self, value):
         self._brake_target = value
 
@@ -64,6 +187,7 @@ class PhysicsControl:
         return self._forward_speed
 
     @forward_speed.setter
+    @synchronized
     def forward_speed(self, value):
         if value >= 0:
             self._forward_speed = value
@@ -74,6 +198,7 @@ class PhysicsControl:
     """
     Setters
     """
+    @synchronized
     def set_speed_values(self, forward_speed, max_speed):
         self.forward_speed = forward_speed
         self._current_speed = int(forward_speed * 3.6)
@@ -85,6 +210,7 @@ class PhysicsControl:
     * left
     """
 
+    @synchronized
     def right(self, value):
         self._turn = True
         if self._steer < value or not self.steer_back_slowly:
@@ -94,6 +220,7 @@ class PhysicsControl:
         else:
             self._steer_target = value
 
+    @synchronized
     def left(self, value):
         self._turn = True
         if self._steer > value or not self.steer_back_slowly:
@@ -104,71 +231,135 @@ class PhysicsControl:
             self._steer_target = value * -1
 
     """
-    Threads
-    * control_steer_value
-    * control_throttle_value
-    * brake_to_target_value
+    Ramps, stepped by the scheduler
+    * steer_step
+    * throttle_step
+    * brake_step
     """
 
-    def _control_steer_value(self):
-        while True:
-            if self._steer_target != 0:
-                if self._steer < self._steer_target:
-                    value = 0.1 if self._steer > 0 else 0.02
-                    self._steer += value
-                    if self._steer > self._steer_target:
-                        self.steer_back_slowly = False
-                        self._steer = self._steer_target
-                else:
-                    value = 0.1 if self._steer < 0 else 0.02
-                    self._steer -= value
-                    if self._steer < self._steer_target:
-                        self.steer_back_slowly = False
-                        self._steer = self._steer_target
-                time.sleep(0.2)
-            else:
-                time.sleep(0.1)
+    def _steer_active(self):
+        return self._steer_target != 0 and (self._steer != self._steer_target or self.steer_back_slowly)
 
-    def _control_throttle_value(self):
-        while True:
-            if self._throttle < self._throttle_target:
-                self._throttle += 0.075
-                if self._throttle > self._throttle_target:
-                    self._throttle = self._throttle_target
-            time.sleep(0.25)
+    def _steer_step(self):
+        if self._steer < self._steer_target:
+            value = 0.1 if self._steer > 0 else 0.02
+            self._steer += value
+            if self._steer > self._steer_target:
+                self.steer_back_slowly = False
+                self._steer = self._steer_target
+        else:
+            value = 0.1 if self._steer < 0 else 0.02
+            self._steer -= value
+            if self._steer < self._steer_target:
+                self.steer_back_slowly = False
+                self._steer = self._steer_target
+
+    def _throttle_active(self):
+        return self._throttle < self._throttle_target
+
+    def _throttle_step(self):
+        self._throttle += 0.075
+        if self._throttle > self._throttle_target:
+            self._throttle = self._throttle_target
+
+    def _brake_active(self):
+        return self._brake_target != 0 and self._brake_target < self._current_speed
+
+    def _brake_step(self):
+        diff = self._current_speed - self._brake_target
+        if diff > 20:
+            value = 0.5
+        elif diff > 15:
+            value = 0.25
+        elif diff > 10:
+            value = 0.15
+        elif diff > 5:
+            value = diff / 100
+        else:
+            value = diff / 200
+        if self._brake_target < 15:
+            value *= 1.5
+        self.brake(value)
 
+    def _ramps_active(self):
+        return self._steer_active() or self._throttle_active() or self._brake_active()
+
+    def _advance(self, dt):
+        """
+        Step every active ramp by dt seconds, called with the lock held
+        return:
+            True while a ramp is still active
+        """
+        if self._steer_active():
+            self._steer_elapsed += dt
+            while self._steer_elapsed >= STEER_INTERVAL and self._steer_active():
+                self._steer_elapsed -= STEER_INTERVAL
+                self._steer_step()
+        else:
+            self._steer_elapsed = 0
+        if self._throttle_active():
+            self._throttle_elapsed += dt
+            while self._throttle_elapsed >= THROTTLE_INTERVAL and self._throttle_active():
+                self._throttle_elapsed -= THROTTLE_INTERVAL
+                self._throttle_step()
+        else:
+            self._throttle_elapsed = 0
+        if self._brake_active():
+            self._brake_elapsed += dt
+            while self._brake_elapsed >= BRAKE_INTERVAL and self._brake_active():
+                self._brake_elapsed -= BRAKE_INTERVAL
+                self._brake_step()
+        else:
+            self._brake_elapsed = 0
+        return self._ramps_active()
+
+    @property
+    def stepped(self):
+        return self._time is not None
+
+    def _now(self):
+        return time.time() if self._time is None else self._time
+
+    @synchronized
+    def step(self, dt, maintain=True):
+        """
+        Advance a stepped controller by dt simulated seconds
+        Ramps step exactly as often as the scheduler would step them in dt seconds
+        params:
+            [1] dt: simulated seconds
+            [2] maintain: also run maintain_speed at the new time
+        """
+        if not self.stepped:
+            raise RuntimeError("step() needs a controller created with stepped=True")
+        self._time += dt
+        self._advance(dt)
+        if maintain:
+            self.maintain_speed()
+
+    def close(self):
+        """
+        Stop driving this controller's ramps
+        """
+        if self._scheduler:
+            self._scheduler.remove(self)
+
+    @synchronized
     def brake(self, value):
         self._brake_val = value
         self._last_max = 0
         self._throttle = 0
         self._throttle_target = 0
 
+    @synchronized
     def accelerate(self, value):
         self._throttle_target = value
         self._last_max = 0
 
+    @synchronized
     def set_brake_target(self, speed):
         self._brake_target = speed
 
-    def _brake_to_target_value(self):
-        while True:
-            if self._brake_target != 0 and self._brake_target < self._current_speed:
-                diff = self._current_speed - self._brake_target
-                if diff > 20:
-                    value = 0.5
-                elif diff > 15:
-                    value = 0.25
-                elif diff > 10:
-                    value = 0.15
-                elif diff > 5:
-                    value = diff / 100
-                else:
-                    value = diff / 200
-                if self._brake_target < 15:
-                    value *= 1.5
-                self.brake(value)
-            time.sleep(0.2)
-
+    @synchronized
     def set_maintain_settings(self, max_speed=None):
         if self._last_max == 0 and self.forward_speed > 0.1:
             if not max_speed:
@@ -189,8 +380,9 @@ class PhysicsControl:
             else:
                 self._throttle = 0.7
 
+    @synchronized
     def maintain_speed(self):
-        if time.time() - self._maintain_time_stamp > self._next_interval and self._last_max > 0:
+        if self._now() - self._maintain_time_stamp > self._next_interval and self._last_max > 0:
             if abs(self._current_speed - self._last_max) > 20:
                 self.brake(0.3)
                 self._next_interval = 1
@@ -207,8 +399,9 @@ class PhysicsControl:
                     self._throttle += 0.04
                 self._next_interval = 3 if self._last_max > 15 else 1
 
-            self._maintain_time_stamp = time.time()
+            self._maintain_time_stamp = self._now()
 
+    @synchronized
     def reset_brake_value(self):
         self._brake_val = 0
 
@@ -216,4 +409,145 @@ class PhysicsControl:
         return self._steer != 0 or self._throttle != 0 or self.brake != 0
 
     def get_values(self):
-        return Values(steer=self._steer, throttle=self._throttle, brake=self._brake_val)
+        with self._lock:
+            return Values(steer=self._steer, throttle=self._throttle, brake=self._brake_val)
+
+
+
+class PhysicsBatch:
+    """
+    Stepped PhysicsControl state of many vehicles as arrays, advanced by one vectorized step(dt)
+    Every field is an array with one entry per vehicle, and can be changed between steps
+    """
+    _fields = {
+        "steer": "_steer",
+        "throttle": "_throttle",
+        "brake": "_brake_val",
+        "current_speed": "_current_speed",
+        "max_speed": "_max_speed",
+        "last_max": "_last_max",
+        "maintain_time_stamp": "_maintain_time_stamp",
+        "next_interval": "_next_interval",
+        "steer_back_slowly": "steer_back_slowly",
+        "steer_target": "_steer_target",
+        "throttle_target": "_throttle_target",
+        "brake_target": "_brake_target",
+        "steer_elapsed": "_steer_elapsed",
+        "throttle_elapsed": "_throttle_elapsed",
+        "brake_elapsed": "_brake_elapsed",
+        "time": "_time",
+    }
+
+    def __init__(self, size):
+        for name in self._fields:
+            setattr(self, name, np.zeros(size, dtype=bool if name == "steer_back_slowly" else np.float64))
+        self.maintain_time_stamp[:] = float("-inf")
+        self.next_interval[:] = 1
+
+    def __len__(self):
+        return len(self.steer)
+
+    @classmethod
+    def from_controls(cls, controls):
+        """
+        Snapshot the state of PhysicsControl instances
+        """
+        batch = cls(len(controls))
+        for i, control in enumerate(controls):
+            if not control.stepped:
+                raise ValueError("PhysicsBatch needs controllers created with stepped=True")
+            with control._lock:
+                for name, attribute in cls._fields.items():
+                    getattr(batch, name)[i] = getattr(control, attribute)
+        return batch
+
+    def apply_to(self, controls):
+        """
+        Write the state back to PhysicsControl instances, in from_controls order
+        """
+        for i, control in enumerate(controls):
+            with control._lock:
+                for name, attribute in self._fields.items():
+                    value = getattr(self, name)[i].item()
+                    setattr(control, attribute, value)
+
+    def get_values(self):
+        return Values(steer=self.steer.copy(), throttle=self.throttle.copy(), brake=self.brake.copy())
+
+    def _brake(self, where, value):
+        self.brake[where] = value
+        self.last_max[where] = 0
+        self.throttle[where] = 0
+        self.throttle_target[where] = 0
+
+    def _steer_active(self):
+        return (self.steer_target != 0) & ((self.steer != self.steer_target) | self.steer_back_slowly)
+
+    def _steer_step(self, due):
+        up = self.steer < self.steer_target
+        steer = np.where(
+            up,
+            self.steer + np.where(self.steer > 0, 0.1, 0.02),
+            self.steer - np.where(self.steer < 0, 0.1, 0.02)
+        )
+        overshoot = due & np.where(up, steer > self.steer_target, steer < self.steer_target)
+        steer[overshoot] = self.steer_target[overshoot]
+        self.steer_back_slowly[overshoot] = False
+        self.steer[due] = steer[due]
+
+    def _throttle_active(self):
+        return self.throttle < self.throttle_target
+
+    def _throttle_step(self, due):
+        self.throttle[due] = np.minimum(self.throttle[due] + 0.075, self.throttle_target[due])
+
+    def _brake_active(self):
+        return (self.brake_target != 0) & (self.brake_target < self.current_speed)
+
+    def _brake_step(self, due):
+        diff = self.current_speed - self.brake_target
+        value = np.select(
+            [diff > 20, diff > 15, diff > 10, diff > 5],
+            [0.5, 0.25, 0.15, diff / 100],
+            diff / 200
+        )
+        value = np.where(self.brake_target < 15, value * 1.5, value)
+        self._brake(due, value[due])
+
+    @staticmethod
+    def _advance_ramp(dt, elapsed, interval, active, step):
+        elapsed[:] = np.where(active(), elapsed + dt, 0)
+        while True:
+            due = (elapsed >= interval) & active()
+            if not due.any():
+                return
+            elapsed[due] -= interval
+            step(due)
+
+    def maintain_speed(self):
+        due = (self.time - self.maintain_time_stamp > self.next_interval) & (self.last_max > 0)
+        diff = np.abs(self.current_speed - self.last_max)
+        faster = self.current_speed > self.last_max
+        slow_interval = np.where(self.last_max > 15, 3, 1)
+
+        far = due & (diff > 20)
+        medium = due & ~far & (diff > 10)
+        near = due & ~far & ~medium & (diff > 5)
+        step = np.where(medium, np.where(self.last_max > 15, 0.07, 0.05), 0.04)
+        adjust = medium | near
+        self.throttle[adjust] += np.where(faster, -step, step)[adjust]
+        self.next_interval[adjust] = slow_interval[adjust]
+        self._brake(far, 0.3)
+        self.next_interval[far] = 1
+        self.maintain_time_stamp[due] = self.time[due]
+
+    def step(self, dt, maintain=True):
+        """
+        Same as PhysicsControl.step(dt) on every vehicle
+        """
+        self.time += dt
+        self._advance_ramp(dt, self.steer_elapsed, STEER_INTERVAL, self._steer_active, self._steer_step)
+        self._advance_ramp(dt, self.throttle_elapsed, THROTTLE_INTERVAL, self._throttle_active, self._throttle_step)
+        self._advance_ramp(dt, self.brake_elapsed, BRAKE_INTERVAL, self._brake_active, self._brake_step)
+        if maintain:
+            self.maintain_speed()